@@ -6,3 +6,6 @@ docker build -t dictionary_container dictionary
 
 echo Building mongo_client_container image...
 docker build -t mongo_client_container mongodb
+
+echo Building wordle_router image...
+docker build -t wordle_router router
@@ -1,14 +1,48 @@
 
 import socket
 import json
+import time
 
 
 wordle_server_port =  12347
 wordle_server_ip = "127.0.0.1"
 
-word_length = 5
+word_length = 5 # defaults, the player can pick others for every game
 guesses_limit = 6
 
+max_packet_size = 16 * 1024 * 1024
+
+def send_packet(sock, packet):
+    """sends one json packet prefixed with its 4-byte length, so the receiver knows where it ends"""
+    data = packet.encode()
+    sock.sendall(len(data).to_bytes(4, "big") + data)
+
+def recv_exactly(sock, size):
+    """reads until size bytes arrived, or less if the peer closed the connection"""
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(min(size - len(buffer), 65536))
+        if not chunk:
+            break
+        buffer += chunk
+    return bytes(buffer)
+
+def recv_packet(sock):
+    """:returns: the next json packet, or an empty string if the peer closed the connection"""
+    header = recv_exactly(sock, 4)
+    if not header:
+        return ""
+    if len(header) < 4:
+        raise ConnectionResetError("connection closed mid-packet")
+    size = int.from_bytes(header, "big")
+    if size > max_packet_size:
+        raise ValueError(f"packet of {size} bytes is too large")
+    data = recv_exactly(sock, size)
+    if len(data) < size:
+        raise ConnectionResetError("connection closed mid-packet")
+    return data.decode()
+
+
 def print_guess_info(guess, guess_info):
     guess = guess.upper()
     for letter, info in zip(guess, guess_info):
@@ -20,91 +54,150 @@ def print_guess_info(guess, guess_info):
             print(f"[{letter}]", end=" ")
     print("")
 
-def print_instructions():
+def print_instructions(word_length, guesses_limit):
     print("Welcome to Wordle!")
     print(f"The word is {word_length} letters long.")
-    print(f"You have {word_length} guesses.")
+    print(f"You have {guesses_limit} guesses.")
     print("For each guess, you will receive feedback:")
     print("  - A letter in the correct position will be surrounded by square brackets: [A]")
     print("  - A correct letter in the wrong position will be surrounded by parentheses: (A)")
     print("  - An incorrect letter will be surrounded by spaces:  A  ")
+    print("Enter ? instead of a guess for a hint.")
     print("Good luck!")
     print("")
 
 
-def send_ack(server_socket):
-    ack = json.dumps({"packet_type": "ack"})
-    server_socket.send(ack.encode())
-
-
-def play_wordle(server_socket, token):
-
-    server_socket.send(json.dumps({"packet_type": "play", "token": token}).encode())
+def play_wordle(server_socket, token, resume=False, daily=False):
+    length, limit = word_length, guesses_limit
+    if resume:
+        send_packet(server_socket, json.dumps({"packet_type": "resume", "token": token}))
+    else:
+        if not daily:
+            length, limit = choose_game_size()
+        hard_mode = input("Hard mode? revealed hints must be used in later guesses (y/n): ") == "y"
+        send_packet(server_socket, json.dumps({"packet_type": "play", "token": token, "hard_mode": hard_mode, "daily": daily,
+                                               "word_length": length, "guesses_number": limit}))
 
     guess = None
     guesses_history = []
-    print_instructions()
+    started = False
     while True:
         print("Waiting for game response...")
-        response_json = server_socket.recv(4096).decode()
+        response_json = recv_packet(server_socket)
         #print(response_json)
         response = json.loads(response_json)
 
         packet_type = response["packet_type"]
+        if packet_type == "error" and not started: # the game never started, e.g. there was nothing to resume
+            print(response["response"])
+            break
+        if not started and packet_type == "waiting_for_guess":
+            print_instructions(length, limit)
+        started = True
         if packet_type == "waiting_for_guess":
             guess = enter_guess(response, server_socket)
+        elif packet_type == "resumed":
+            guesses_history = list(zip(response["guesses"], response["results"]))
+            print_instructions(response["word_length"], response["guesses_number"])
+            print("Resuming your " + ("daily challenge" if response.get("daily") else "game") + (" in hard mode" if response["hard_mode"] else ""))
+            print_current_game(guesses_history)
         elif packet_type == "wordle_result":
             guess_info = response["response"]
             guesses_history.append((guess, guess_info))
             print_current_game(guesses_history)
-            send_ack(server_socket)
+            if response.get("remaining") is not None:
+                print(f"{response['remaining']} possible words left")
+        elif packet_type == "hint":
+            print(f"Hint: {response['response'].upper()} ({response['remaining']} possible words left)")
         elif packet_type == "message":
             print(response["message"])
-            send_ack(server_socket)
         elif packet_type == "error":
             print(response["response"])
-            send_ack(server_socket)
         elif packet_type == "game_over":
             print(response["game_over_message"])
             print("The word was: ", response["word"].upper())
-            send_ack(server_socket)
+            if response.get("daily_rank"):
+                print(f"Your rank today: {response['daily_rank']['rank']} of {response['daily_rank']['players']}")
             break
         else:
             print("Invalid packet type: ", packet_type)
-            send_ack(server_socket)
+
+
+def choose_game_size():
+    """:returns: word length and guess limit entered by the player, the defaults for empty answers"""
+    while True:
+        try:
+            length = int(input(f"Word length, 4 to 8 [{word_length}]: ") or word_length)
+            limit = int(input(f"Guess limit [{guesses_limit}]: ") or guesses_limit)
+            return length, limit
+        except ValueError:
+            print("Enter a number")
 
 
 def enter_guess(response, server_socket):
     guess_number = response["guess_number"]
     guess = input(f"enter your #{guess_number} guess: ")
+    if guess == "?":
+        send_packet(server_socket, json.dumps({"packet_type": "hint"}))
+        return None
     guess_json = json.dumps({"packet_type": "guess", "guess": guess})
-    server_socket.send(guess_json.encode())
+    send_packet(server_socket, guess_json)
     return guess
 
 
-def get_stats(history):
-    total_games = len(history)
-    total_wins = 0
-    for game in history:
-        if game['game_data']['win']:
-            total_wins += 1
-    total_losses = total_games - total_wins
-
-    return {"total_games": total_games, "wins": total_wins, "losses": total_losses, "win_rate": (total_wins / total_games if total_games > 0 else 0)}
 def print_stats(server_socket, token):
 
-    server_socket.send(json.dumps({"packet_type": "history", "token": token}).encode())
+    send_packet(server_socket, json.dumps({"packet_type": "stats", "token": token}))
     print("Getting stats...")
-    response_json = server_socket.recv(4096).decode()
+    response_json = recv_packet(server_socket)
     response = json.loads(response_json)
     #print(response)
     if response["packet_type"] == "error":
         print("Could not get stats")
         return
-    print("Game history:", response["history"])
 
-    stats = get_stats(response["history"])
-    print("Stats:", stats)
+    stats = response["stats"]
+    print(f"Games: {stats['total_games']}, wins: {stats['wins']}, losses: {stats['losses']}, win rate: {stats['win_rate']:.0%}")
+    print(f"Current streak: {stats['current_streak']}, max streak: {stats['max_streak']}")
+    for guesses_count, wins in sorted(stats["guess_distribution"].items(), key=lambda item: int(item[0])):
+        print(f"  won in {guesses_count}: {wins}")
+
+history_page_size = 10
+
+def print_history(server_socket, token):
+    """shows the games newest first, one page at a time, the next page only if the player asks for it"""
+    before = None
+    while True:
+        send_packet(server_socket, json.dumps({"packet_type": "history", "token": token, "before": before, "limit": history_page_size}))
+        response = json.loads(recv_packet(server_socket))
+        if response["packet_type"] == "error":
+            print("Could not get history")
+            return
+        if not response["history"] and before is None:
+            print("No games yet")
+            return
+        for game in response["history"]:
+            game_data = game["game_data"]
+            result = f"won in {len(game_data['guesses'])}" if game_data["win"] else "lost"
+            played = time.strftime("%Y-%m-%d %H:%M", time.localtime(game["timestamp"]))
+            print(f"  {played}  {game_data['word'].upper():<8} {result}" + (", daily" if game_data.get("daily") else ""))
+        before = response.get("next_before")
+        if before is None or input("More? (y/n): ") != "y":
+            return
+
+def print_leaderboard(server_socket, token):
+    send_packet(server_socket, json.dumps({"packet_type": "leaderboard", "token": token}))
+    response = json.loads(recv_packet(server_socket))
+    if response["packet_type"] == "error":
+        print("Could not get the leaderboard")
+        return
+
+    print(f"Daily challenge {response['date']}, {response['players']} players")
+    for entry in response["top"]:
+        result = f"{entry['guesses']} guesses" if entry["solved"] else "not solved"
+        print(f"  {entry['rank']:>3}. {entry['username']:<20} {result}, {entry['seconds']:.0f}s")
+    if response["me"] is not None:
+        print(f"Your rank: {response['me']['rank']}")
 
 def print_current_game(guesses_history):
     for i, (word, guess_info) in enumerate(guesses_history):
@@ -114,9 +207,9 @@ def print_current_game(guesses_history):
 
 
 def clear_history(server_socket, token):
-    server_socket.send(json.dumps({"packet_type": "clear_history", "token": token}).encode())
+    send_packet(server_socket, json.dumps({"packet_type": "clear_history", "token": token}))
     print("Clearing history...")
-    response_json = server_socket.recv(4096).decode()
+    response_json = recv_packet(server_socket)
     response = json.loads(response_json)
     if response["response"] == "success":
         print("History cleared")
@@ -131,8 +224,8 @@ def change_password(server_socket, token):
         print("Passwords do not match")
         return
 
-    server_socket.send(json.dumps({"packet_type": "change_password", "token": token, "new_password": new_password}).encode())
-    response_json = server_socket.recv(4096).decode()
+    send_packet(server_socket, json.dumps({"packet_type": "change_password", "token": token, "new_password": new_password}))
+    response_json = recv_packet(server_socket)
     response = json.loads(response_json)
     if response["response"] == "success":
         print("Password changed")
@@ -163,8 +256,8 @@ def main():
             server_socket.settimeout(5.0)
 
             user_info = json.dumps({"packet_type": packet_type, "username": username, "password": password})
-            server_socket.send(user_info.encode())
-            response_json = server_socket.recv(4096).decode()
+            send_packet(server_socket, user_info)
+            response_json = recv_packet(server_socket)
             #print(response_json)
             response = json.loads(response_json)
             if response["packet_type"] == "response" and response["response"] == "success":
@@ -178,18 +271,26 @@ def main():
 
     while True:
         try:
-            choice = input("what would you like to do? (play, quit, stats, clear_history, change_password): ")
+            choice = input("what would you like to do? (play, daily, resume, leaderboard, quit, stats, history, clear_history, change_password): ")
 
             if choice == "stats":
                 print_stats(server_socket, token)
+            elif choice == "history":
+                print_history(server_socket, token)
             elif choice == "clear_history":
                 clear_history(server_socket, token)
             elif choice == "play":
                 play_wordle(server_socket, token)
+            elif choice == "resume":
+                play_wordle(server_socket, token, resume=True)
+            elif choice == "daily":
+                play_wordle(server_socket, token, daily=True)
+            elif choice == "leaderboard":
+                print_leaderboard(server_socket, token)
             elif choice == "change_password":
                 change_password(server_socket, token)
             elif choice == "quit":
-                server_socket.send(json.dumps({"packet_type": "logout"}).encode())
+                send_packet(server_socket, json.dumps({"packet_type": "logout", "token": token}))
                 break
             else:
                 print("Invalid choice")
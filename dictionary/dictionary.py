@@ -1,7 +1,26 @@
+import hashlib
 import json
+import logging
+import mmap
+import os
+import queue
+import random
 import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
+import metrics
+import protocol
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s %(message)s")
+logger = logging.getLogger("dictionary")
+metrics.namespace = "dictionary"
+metrics_port = int(os.environ.get("METRICS_PORT", "9103"))
+
 endpoints = {
   "dictionary": {
     "ip": 'dictionary_container',
@@ -18,87 +37,449 @@ endpoints = {
   "wordle": {
     "ip": 'wordle_container',
     "port": 12347
+  },
+  "router": {
+    "ip": 'wordle_router',
+    "port": 12347
   }
 }
+# a json file of the same shape in ENDPOINTS_FILE, then <NAME>_IP and <NAME>_PORT variables, override the defaults above
+if os.environ.get("ENDPOINTS_FILE"):
+    with open(os.environ["ENDPOINTS_FILE"]) as endpoints_file:
+        for name, endpoint in json.load(endpoints_file).items():
+            endpoints.setdefault(name, {}).update(endpoint)
+for name, endpoint in endpoints.items():
+    endpoint["ip"] = os.environ.get(f"{name.upper()}_IP", endpoint["ip"])
+    endpoint["port"] = int(os.environ.get(f"{name.upper()}_PORT", endpoint["port"]))
 
 dictionary_endpoint = endpoints["dictionary"]
 dictionary_server_port = dictionary_endpoint["port"]
 dictionary_server_ip = dictionary_endpoint["ip"]
-print(f"Dictionary server: {dictionary_server_ip}:{dictionary_server_port}")
+logger.info("Dictionary server: %s:%s", dictionary_server_ip, dictionary_server_port)
 
-def get_random_word(length=5):
+request_workers = ThreadPoolExecutor(max_workers=int(os.environ.get("REQUEST_WORKERS", "32"))) # run the requests of multiplexed connections
+
+def send_packet(client, packet):
+    """sends one packet to the caller of a request, in the encoding of its connection"""
+    client.send(packet)
+
+
+word_list_path = os.environ.get("WORD_LIST", "words.txt")
+use_api_fallback = os.environ.get("DICTIONARY_API_FALLBACK", "0") == "1" # ask the online apis when the local list has no answer
+
+packed_words_directory = os.environ.get("PACKED_WORDS", "packed_words")
+
+# Every length is packed into its own file: the sorted words as fixed width ascii rows, with nothing in between.
+# The file is memory-mapped and searched in place, so opening it is instant whatever the size of the list,
+# no python string is made for a word that isn't asked for, and processes reading the same file share its pages.
+
+
+class PackedWords:
+    """Read-only sorted sequence of the words of one length in a packed file"""
+    def __init__(self, path, length):
+        self.length = length
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b"" # an empty file can't be mapped
+        self.count = size // length
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return self.data[index * self.length:(index + 1) * self.length].decode()
+
+    def __contains__(self, word):
+        if len(word) != self.length or not word.isascii():
+            return False
+        key = word.encode()
+        low, high = 0, self.count
+        while low < high: # binary search, about 11 probes for 2000 words and 20 for a million
+            middle = (low + high) // 2
+            row = self.data[middle * self.length:(middle + 1) * self.length]
+            if row < key:
+                low = middle + 1
+            elif row > key:
+                high = middle
+            else:
+                return True
+        return False
+
+    def words(self) -> list:
+        data = self.data[:]
+        return [data[i:i + self.length].decode() for i in range(0, len(data), self.length)]
+
+
+def read_word_list(path):
+    """:returns: length: sorted distinct words of the list at path, only plain ascii letters fit the packed rows"""
+    words_by_length = {}
+    try:
+        with open(path) as file:
+            for line in file:
+                word = line.strip().lower()
+                if word.isascii() and word.isalpha():
+                    words_by_length.setdefault(len(word), set()).add(word)
+    except FileNotFoundError:
+        logger.warning("word list %r not found", path)
+    return {length: sorted(words) for length, words in words_by_length.items()}
+
+def packed_path(directory, length):
+    return os.path.join(directory, f"words_{length}.bin")
+
+def pack_word_list(path=None, directory=None, lengths=None):
+    """writes the packed file of every length in the list at path, or only of lengths, each one atomically"""
+    path = path or word_list_path
+    directory = directory or packed_words_directory
+    os.makedirs(directory, exist_ok=True)
+    words_by_length = read_word_list(path)
+    for length in lengths or words_by_length:
+        temporary_path = f"{packed_path(directory, length)}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as file:
+            file.write("".join(words_by_length.get(length, [])).encode())
+        os.replace(temporary_path, packed_path(directory, length)) # other workers never see a half written file
+        logger.info("packed %d words of length %d", len(words_by_length.get(length, [])), length)
+
+def is_packed_file_current(length):
+    try:
+        return os.path.getmtime(packed_path(packed_words_directory, length)) >= os.path.getmtime(word_list_path)
+    except FileNotFoundError:
+        return not os.path.exists(word_list_path) and os.path.exists(packed_path(packed_words_directory, length))
+
+
+packed_words = {} # length: PackedWords, opened on first use
+packed_words_lock = threading.Lock()
+
+def local_words(length) -> PackedWords:
+    """:returns: the sorted local words of this length, empty if there are none"""
+    words = packed_words.get(length)
+    if words is None:
+        with packed_words_lock:
+            if length not in packed_words:
+                if not is_packed_file_current(length):
+                    pack_word_list(lengths=[length])
+                packed_words[length] = PackedWords(packed_path(packed_words_directory, length), length)
+            words = packed_words[length]
+    return words
+
+longest_word = 45 # no list has longer words, longer guesses must not create a packed file each
+
+def is_local_word(word):
+    if len(word) > longest_word or not word.isalpha():
+        return False
+    return word in local_words(len(word))
+
+
+class ValidationCache:
+    """Bounded LRU of online dictionary answers, valid and invalid ones, each kept until its TTL runs out.
+    Saved to a file in the background, so it is preloaded after a restart."""
+    def __init__(self, path, max_size=100000, valid_ttl=30*24*3600, invalid_ttl=24*3600):
+        self.path = path
+        self.max_size = max_size
+        self.valid_ttl = valid_ttl
+        self.invalid_ttl = invalid_ttl
+        self.entries = OrderedDict() # word: [valid, expires_at], least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.changed = False
+
+    def get(self, word):
+        """:returns: True/False if the answer is cached, None on a miss"""
+        with self.lock:
+            entry = self.entries.get(word)
+            if entry is None or entry[1] < time.time():
+                if entry is not None:
+                    del self.entries[word]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(word)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, word, valid):
+        ttl = self.valid_ttl if valid else self.invalid_ttl
+        with self.lock:
+            self.entries[word] = [valid, time.time() + ttl]
+            self.entries.move_to_end(word)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            self.changed = True
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                saved = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("could not load validation cache: %r", e)
+            return
+        now = time.time()
+        with self.lock:
+            for word, entry in saved: # saved least recently used first
+                if entry[1] >= now:
+                    self.entries[word] = entry
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        logger.info("loaded %d cached validations", len(self.entries))
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            saved = list(self.entries.items())
+            self.changed = False
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(saved, file)
+        os.replace(temporary_path, self.path)
+
+    def save_periodically(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.save()
+            except OSError as e:
+                logger.warning("could not save validation cache: %r", e)
+
+
+validation_cache = ValidationCache(
+    os.environ.get("VALIDATION_CACHE", "validation_cache.json"),
+    max_size=int(os.environ.get("VALIDATION_CACHE_SIZE", "100000")),
+    valid_ttl=float(os.environ.get("VALIDATION_CACHE_VALID_TTL", str(30*24*3600))),
+    invalid_ttl=float(os.environ.get("VALIDATION_CACHE_INVALID_TTL", str(24*3600))),
+)
+validation_cache_save_interval = float(os.environ.get("VALIDATION_CACHE_SAVE_INTERVAL", "60"))
+
+
+def get_random_word_api(length=5):
     url = f"https://random-word-api.herokuapp.com/word?length={length}"
     while True:
-        result_json = requests.get(url,timeout=5).json()
-        print(result_json)
+        with metrics.timed("http_request_seconds", api="random_word"):
+            result_json = requests.get(url,timeout=5).json()
+        logger.debug("random word api: %s", result_json)
         word = result_json[0]
         if is_word_valid(word):
-            print("returning word: ", word)
             return word
 
-def is_word_valid(word):
+def is_word_valid_api(word):
     url = f"https://api.dictionaryapi.dev/api/v2/entries/en/{word}"
-    response = requests.get(url,timeout=5).json()
-    print(response)
+    with metrics.timed("http_request_seconds", api="dictionary"):
+        response = requests.get(url,timeout=5).json()
+    logger.debug("dictionary api: %s", response)
     if type(response) == list: #get the first element of the list if multiple definitions are found
         response = response[0]
     if "title" in response and response["title"] == "No Definitions Found":
-        print(f"word \"{word}\" is invalid")
         return False
-    print(f"word \"{word}\" is valid")
     return True
 
 
+def pick_random_word(length=5):
+    words = local_words(length)
+    if words:
+        word = random.choice(words)
+    elif use_api_fallback:
+        word = get_random_word_api(length)
+    else:
+        raise ValueError(f"No words of length {length}")
+    return word
+
+
+word_buffer_depth = int(os.environ.get("WORD_BUFFER_DEPTH", "32"))
+word_buffer_refill_threshold = int(os.environ.get("WORD_BUFFER_REFILL_THRESHOLD", "8"))
+word_buffer_lengths = [int(length) for length in os.environ.get("WORD_BUFFER_LENGTHS", "5").split(",") if length] # filled at startup
+
+
+class WordBuffer:
+    """Answer words of one length picked ahead of time, a background thread tops it up
+    whenever it drops to the refill threshold, so a new game never waits on the upstream api"""
+    def __init__(self, length, depth=word_buffer_depth, refill_threshold=word_buffer_refill_threshold):
+        self.length = length
+        self.refill_threshold = refill_threshold
+        self.words = queue.Queue(maxsize=depth)
+        self.refill_needed = threading.Event()
+        self.refill_needed.set()
+        threading.Thread(target=self.refill, daemon=True).start()
+
+    def refill(self):
+        while True:
+            self.refill_needed.wait()
+            self.refill_needed.clear()
+            while not self.words.full():
+                try:
+                    self.words.put(pick_random_word(self.length))
+                except Exception as e:
+                    logger.warning("could not refill %d letter words: %r", self.length, e)
+                    time.sleep(1)
+
+    def pop(self):
+        try:
+            word = self.words.get_nowait()
+        except queue.Empty:
+            word = pick_random_word(self.length) # ran dry, don't make the player wait for the refill
+        if self.words.qsize() <= self.refill_threshold:
+            self.refill_needed.set()
+        return word
+
+
+word_buffers = {} # length: WordBuffer
+word_buffers_lock = threading.Lock()
+
+def get_word_buffer(length):
+    with word_buffers_lock:
+        if length not in word_buffers:
+            if not local_words(length) and not use_api_fallback:
+                raise ValueError(f"No words of length {length}")
+            word_buffers[length] = WordBuffer(length)
+        return word_buffers[length]
+
+def get_random_word(length=5):
+    return get_word_buffer(length).pop()
+
+def is_word_valid(word):
+    word = word.lower()
+    if is_local_word(word):
+        return True
+    if not use_api_fallback:
+        return False
+    result = validation_cache.get(word)
+    if result is None:
+        result = is_word_valid_api(word)
+        validation_cache.put(word, result)
+    return result
+
+
 
 def validate_word_service(client, request):
     word = request["word"]
     result = is_word_valid(word)
-    response = json.dumps({"response": result})
-    message = "valid" if result else "invalid"
-    print(f"word \"{word}\" is {message}")
-    client.send(response.encode())
+    response = {"response": result}
+    logger.debug("word %r valid: %s", word, result)
+    send_packet(client, response)
 
 
 def random_word_service(client, request):
     length = request["length"]
     word = get_random_word(length)
-    response = json.dumps({"response": word})
-    print("returning word: ", word)
-    client.send(response.encode())
+    response = {"response": word}
+    logger.debug("returning word: %s", word)
+    send_packet(client, response)
+
+def word_list_service(client, request):
+    """every local word of one length, sorted so every caller builds the same solver tables from it"""
+    words = local_words(request["length"]).words()
+    send_packet(client, {"response": words})
+
+daily_seed = os.environ.get("DAILY_SEED", "wordle") # every dictionary replica with the same seed and list picks the same word
+
+def daily_word(date, length=5):
+    """:returns: the daily challenge word of date, the same for every player and replica"""
+    words = local_words(length)
+    if not words:
+        raise ValueError(f"No words of length {length}")
+    digest = hashlib.sha256(f"{daily_seed}:{date}:{length}".encode()).digest()
+    return words[int.from_bytes(digest[:8], "big") % len(words)]
+
+def daily_word_service(client, request):
+    send_packet(client, {"response": daily_word(request["date"], request.get("length", 5))})
+
+def cache_stats_service(client, request):
+    send_packet(client, {"response": validation_cache.stats()})
+
+request_types = {"get_random_word", "validate_word", "get_word_list", "get_daily_word", "cache_stats"}
+
+def handle_request(client, request_data):
+    data = protocol.decode(request_data, client.encoding)
+    packet_type = data["packet_type"]
+    if packet_type == "hello":
+        client.connection.accept_hello(data, client.request_id)
+        return
+    logger.debug("request type: %s", packet_type)
+    label = packet_type if packet_type in request_types else "invalid"
+    metrics.inc("requests_total", packet_type=label)
+    with metrics.timed("request_seconds", packet_type=label):
+        dispatch_request(client, data, packet_type)
+
+def dispatch_request(client, data, packet_type):
+    if packet_type == "get_random_word":
+        random_word_service(client, data)
+    elif packet_type == "validate_word":
+        validate_word_service(client, data)
+    elif packet_type == "get_word_list":
+        word_list_service(client, data)
+    elif packet_type == "get_daily_word":
+        daily_word_service(client, data)
+    elif packet_type == "cache_stats":
+        cache_stats_service(client, data)
+    else:
+        logger.debug("invalid packet type: %s", packet_type)
+        raise ValueError("Invalid packet type")
+
+def serve_request(client, request_data):
+    try:
+        handle_request(client, request_data)
+    except (ConnectionResetError, BrokenPipeError):
+        raise
+    except Exception as e:
+        send_packet(client, {"packet_type": "error", "response": str(e)})
+
+def serve_request_in_worker(client, request_data):
+    try:
+        serve_request(client, request_data)
+    except OSError as e: # the caller left before the response
+        logger.info("connection lost: %r", e)
+
+def client_thread(client):
+    """serves requests from one connection until the peer closes it, so callers can keep their connections open,
+    the requests of a multiplexed connection run side by side on the request workers"""
+    connection = protocol.ServiceConnection(client)
+    try:
+        while True:
+            request = connection.receive()
+            if request is None:
+                break
+            request_id, request_data = request
+            if connection.multiplex:
+                request_workers.submit(serve_request_in_worker, protocol.Reply(connection, request_id), request_data)
+            else:
+                serve_request(protocol.Reply(connection), request_data)
+    except (ConnectionResetError, BrokenPipeError) as e:
+        logger.info("connection lost: %r", e)
+    finally:
+        client.close()
 
 def main():
-    print("Starting dictionary server...")
+    logger.info("starting dictionary server")
+    metrics.serve(metrics_port)
+    metrics.gauge("validation_cache_hits", lambda: validation_cache.hits)
+    metrics.gauge("validation_cache_misses", lambda: validation_cache.misses)
+    metrics.gauge("validation_cache_size", lambda: len(validation_cache.entries))
+    if use_api_fallback:
+        validation_cache.load()
+        threading.Thread(target=validation_cache.save_periodically, args=(validation_cache_save_interval,), daemon=True).start()
+    for length in word_buffer_lengths:
+        get_word_buffer(length)
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # a restart binds while the last run's connections are in TIME_WAIT
     server.bind(("0.0.0.0", dictionary_server_port))
     server.listen()
 
 
     while True:
-        client = None
         try:
-            print("dictionary waiting for connections...")
+            logger.debug("waiting for connections")
             client, addr = server.accept()
-            print("user connected from: ", addr)
-
-            request_json = client.recv(4096).decode()
-
-            data = json.loads(request_json)
-            packet_type = data["packet_type"]
-            print("Request type: ", packet_type)
-
-            if packet_type == "get_random_word":
-                random_word_service(client, data)
-            elif packet_type == "validate_word":
-                validate_word_service(client, data)
-            else:
-                print("Invalid packet type: ", packet_type)
-                raise ValueError("Invalid packet type")
-
+            logger.debug("connection from %s", addr)
+            threading.Thread(target=client_thread, args=(client,), daemon=True).start()
         except Exception as e:
-            client.send(json.dumps({"packet_type": "error", "response": str(e)}).encode())
+            logger.warning("accept failed: %r", e)
             continue
-        finally:
-            client.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,133 @@
+import http.server
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Counters and latency histograms of one service, served in the Prometheus text format.
+# Every service has its own copy of this file, like it has its own copy of the endpoints.
+
+logger = logging.getLogger("metrics")
+
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # seconds
+
+namespace = "" # prefixed to every metric name, set by the service
+
+
+class Histogram:
+    def __init__(self):
+        self.bucket_counts = [0] * len(latency_buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(latency_buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+counters = {} # (name, labels): value
+histograms = {} # (name, labels): Histogram
+gauges = {} # name: function returning the current value
+lock = threading.Lock()
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def inc(name, amount=1, **labels):
+    key = (name, label_key(labels))
+    with lock:
+        counters[key] = counters.get(key, 0) + amount
+
+def observe(name, seconds, **labels):
+    key = (name, label_key(labels))
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+@contextmanager
+def timed(name, **labels):
+    """observes how long the block took in the histogram name, and counts it in <name without _seconds>_errors_total if it raised"""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        inc(f"{name.replace('_seconds', '')}_errors_total", **labels)
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def gauge(name, function):
+    """function is called on every scrape"""
+    gauges[name] = function
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+def render() -> str:
+    prefix = f"{namespace}_" if namespace else ""
+    lines = []
+    typed = set()
+    def declare(name, metric_type):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {prefix}{name} {metric_type}")
+    with lock:
+        for (name, labels), value in sorted(counters.items()):
+            declare(name, "counter")
+            lines.append(f"{prefix}{name}{format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(histograms.items()):
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(latency_buckets, histogram.bucket_counts):
+                cumulative += count
+                lines.append(f"{prefix}{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{prefix}{name}_bucket{format_labels(labels, [('le', '+Inf')])} {histogram.count}")
+            lines.append(f"{prefix}{name}_sum{format_labels(labels)} {histogram.sum}")
+            lines.append(f"{prefix}{name}_count{format_labels(labels)} {histogram.count}")
+    for name, function in sorted(gauges.items()):
+        try:
+            value = function()
+            declare(name, "gauge")
+            lines.append(f"{prefix}{name} {value}")
+        except Exception as e:
+            logger.warning("gauge %s failed: %s", name, e)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # scrapes are not worth a log line
+
+
+def serve(port):
+    """serves /metrics on a daemon thread, the service keeps running without it if the port is taken"""
+    try:
+        server = http.server.ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    except OSError as e:
+        logger.warning("could not serve metrics on port %d: %r", port, e)
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("metrics on port %d", port)
+    return server
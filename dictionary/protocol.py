@@ -0,0 +1,105 @@
+import json
+import threading
+
+try:
+    import msgpack #pip install msgpack
+except ImportError: # the services keep talking json to each other without it
+    msgpack = None
+
+# Packets between the services are dicts, each sent with a 4-byte length prefix like the packets of the players.
+# A service connection starts in json. A caller may open it with a "hello" packet listing the encodings it speaks;
+# the answer names the one both sides use from then on, in both directions. On a multiplexed connection
+# every packet also starts with the 4-byte id of the request it belongs to, so a caller can have many requests
+# in flight on one connection and match each response whatever order they come back in.
+# Every service has its own copy of this file, like it has its own copy of the endpoints.
+
+supported_encodings = ["msgpack", "json"] if msgpack is not None else ["json"] # preferred first
+
+max_packet_size = 16 * 1024 * 1024
+
+
+def encode(packet, encoding) -> bytes:
+    if encoding == "msgpack":
+        return msgpack.packb(packet)
+    return json.dumps(packet).encode()
+
+def decode(data, encoding):
+    if encoding == "msgpack":
+        return msgpack.unpackb(data)
+    return json.loads(data)
+
+def hello(encodings, multiplex=True) -> dict:
+    return {"packet_type": "hello", "encodings": list(encodings), "multiplex": multiplex}
+
+def answer_hello(request) -> dict:
+    """the first encoding the caller offered that we speak too, json if none"""
+    encoding = next((encoding for encoding in request.get("encodings", []) if encoding in supported_encodings), "json")
+    return {"packet_type": "hello", "response": "success", "encoding": encoding, "multiplex": bool(request.get("multiplex"))}
+
+
+def recv_exactly(sock, size):
+    """reads until size bytes arrived, or less if the peer closed the connection"""
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(min(size - len(buffer), 65536))
+        if not chunk:
+            break
+        buffer += chunk
+    return bytes(buffer)
+
+
+class ServiceConnection:
+    """The server side of one service connection, in json and one request at a time until the caller's hello says otherwise"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.encoding = "json"
+        self.multiplex = False
+        self.send_lock = threading.Lock() # responses of requests running side by side must not interleave
+
+    def receive(self):
+        """:returns: (request id, encoded packet) of the next request, None if the caller closed the connection"""
+        header = recv_exactly(self.sock, 4)
+        if not header:
+            return None
+        if len(header) < 4:
+            raise ConnectionResetError("connection closed mid-packet")
+        size = int.from_bytes(header, "big")
+        if size > max_packet_size:
+            raise ValueError(f"packet of {size} bytes is too large")
+        data = recv_exactly(self.sock, size)
+        if len(data) < size:
+            raise ConnectionResetError("connection closed mid-packet")
+        if self.multiplex:
+            return int.from_bytes(data[:4], "big"), data[4:]
+        return None, data
+
+    def send(self, packet, request_id=None):
+        """packet is a dict, or bytes already encoded in the encoding of this connection"""
+        data = packet if isinstance(packet, bytes) else encode(packet, self.encoding)
+        if self.multiplex:
+            data = request_id.to_bytes(4, "big") + data
+        with self.send_lock:
+            self.sock.sendall(len(data).to_bytes(4, "big") + data)
+
+    def accept_hello(self, request, request_id=None):
+        """answers the hello in json, then switches to what it agreed on"""
+        answer = answer_hello(request)
+        self.send(answer, request_id)
+        self.encoding = answer["encoding"]
+        self.multiplex = answer["multiplex"]
+
+
+class Reply:
+    """Where the response to one request goes"""
+    __slots__ = ("connection", "request_id")
+
+    def __init__(self, connection, request_id=None):
+        self.connection = connection
+        self.request_id = request_id
+
+    def send(self, packet):
+        self.connection.send(packet, self.request_id)
+
+    @property
+    def encoding(self):
+        return self.connection.encoding
@@ -0,0 +1,202 @@
+"""Headless load generator for the whole login/play/stats/password flow.
+Every simulated player registers, plays whole games with random guesses, checks its stats and changes its password,
+speaking the same packets as client/client.py. Prints latency percentiles per packet type and games/sec.
+
+usage: python loadgen.py --local --players 50 --games 5
+       python loadgen.py --host 127.0.0.1 --port 12347 --players 50 --games 5
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, "client"))
+
+from client import recv_packet, send_packet, wordle_server_ip, wordle_server_port # noqa: E402
+import standins # noqa: E402
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class Recorder:
+    """Latencies and errors of every player, per packet type"""
+    def __init__(self):
+        self.latencies = {} # packet_type: [seconds]
+        self.errors = {} # description: count
+        self.games = 0
+        self.lock = threading.Lock()
+
+    def record(self, packet_type, seconds):
+        with self.lock:
+            self.latencies.setdefault(packet_type, []).append(seconds)
+
+    def record_error(self, description):
+        with self.lock:
+            self.errors[description] = self.errors.get(description, 0) + 1
+
+    def record_game(self):
+        with self.lock:
+            self.games += 1
+
+    def report(self, elapsed):
+        lines = [f"{'packet':<16}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"]
+        for packet_type, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            lines.append(f"{packet_type:<16}{len(latencies):>8}"
+                         f"{percentile(latencies, 0.50) * 1000:>10.2f}"
+                         f"{percentile(latencies, 0.95) * 1000:>10.2f}"
+                         f"{percentile(latencies, 0.99) * 1000:>10.2f}"
+                         f"{latencies[-1] * 1000:>10.2f}")
+        lines.append(f"{self.games} games in {elapsed:.2f}s, {self.games / elapsed:.2f} games/sec")
+        for description, count in sorted(self.errors.items()):
+            lines.append(f"error x{count}: {description}")
+        return "\n".join(lines)
+
+
+class Player:
+    def __init__(self, number, address, recorder, words, run_id, word_length=5, pattern_feedback=False):
+        self.username = f"loadgen_{run_id}_{number}"
+        self.password = uuid.uuid4().hex
+        self.address = address
+        self.recorder = recorder
+        self.words = words
+        self.word_length = word_length
+        self.pattern_feedback = pattern_feedback
+        self.server_socket = None
+        self.token = None
+
+    def send(self, packet):
+        send_packet(self.server_socket, json.dumps(packet))
+
+    def receive(self):
+        response_json = recv_packet(self.server_socket)
+        if not response_json:
+            raise ConnectionResetError("server closed the connection")
+        return json.loads(response_json)
+
+    def request(self, packet, packet_type=None):
+        """sends one packet and times the wait for its response"""
+        start = time.perf_counter()
+        self.send(packet)
+        response = self.receive()
+        self.recorder.record(packet_type or packet["packet_type"], time.perf_counter() - start)
+        return response
+
+    def login(self):
+        self.server_socket = socket.create_connection(self.address, timeout=30.0)
+        response = self.request({"packet_type": "register", "username": self.username, "password": self.password})
+        if response["packet_type"] != "response" or response["response"] != "success":
+            raise RuntimeError(f"register failed: {response['response']}")
+        self.token = response["token"]
+
+    def play_game(self):
+        play = {"packet_type": "play", "token": self.token, "word_length": self.word_length}
+        if self.pattern_feedback:
+            play["feedback"] = "pattern"
+        response = self.request(play)
+        while response["packet_type"] != "game_over":
+            if response["packet_type"] == "waiting_for_guess":
+                response = self.request({"packet_type": "guess", "guess": random.choice(self.words)})
+            else: # wordle_result or error, the next prompt follows without a request
+                response = self.receive()
+        self.recorder.record_game()
+
+    def check_stats(self):
+        response = self.request({"packet_type": "stats", "token": self.token})
+        if response["packet_type"] == "error":
+            raise RuntimeError(f"stats failed: {response['response']}")
+
+    def change_password(self):
+        self.password = uuid.uuid4().hex
+        self.request({"packet_type": "change_password", "token": self.token, "new_password": self.password})
+
+    def logout(self):
+        self.send({"packet_type": "logout", "token": self.token})
+        self.server_socket.close()
+
+    def run(self, games):
+        try:
+            self.login()
+            for _ in range(games):
+                self.play_game()
+                self.check_stats()
+            self.change_password()
+            self.logout()
+        except Exception as e:
+            self.recorder.record_error(f"{type(e).__name__}: {e}")
+            if self.server_socket is not None:
+                self.server_socket.close()
+
+
+def load_words(path, length=5):
+    with open(path) as file:
+        return [word for word in (line.strip().lower() for line in file) if len(word) == length]
+
+def wait_for_port(port, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1.0).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"nothing is listening on port {port}")
+
+def start_standins():
+    """:returns: running stand-in processes, wordle last, once every one of them accepts connections"""
+    processes = []
+    for service in ["dictionary", "mongo_api", "wordle"]:
+        processes.append(subprocess.Popen([sys.executable, os.path.join(root, "loadtest", "standins.py"), service],
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        wait_for_port(standins.default_ports[service])
+    return processes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--players", type=int, default=10, help="concurrent simulated players")
+    parser.add_argument("--games", type=int, default=3, help="games per player")
+    parser.add_argument("--host", default=wordle_server_ip)
+    parser.add_argument("--port", type=int, default=wordle_server_port)
+    parser.add_argument("--local", action="store_true", help="start offline stand-ins of every service and test those")
+    parser.add_argument("--word-length", type=int, default=5)
+    parser.add_argument("--pattern-feedback", action="store_true", help="ask for results as base-3 patterns instead of lists of names")
+    parser.add_argument("--words", default=os.path.join(root, "dictionary", "words.txt"), help="guesses are drawn from this list")
+    args = parser.parse_args()
+
+    processes = []
+    address = (args.host, args.port)
+    if args.local:
+        processes = start_standins()
+        address = ("127.0.0.1", standins.default_ports["wordle"])
+
+    try:
+        recorder = Recorder()
+        words = load_words(args.words, args.word_length)
+        run_id = uuid.uuid4().hex[:8]
+        players = [Player(number, address, recorder, words, run_id, args.word_length, args.pattern_feedback) for number in range(args.players)]
+        threads = [threading.Thread(target=player.run, args=(args.games,)) for player in players]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print(recorder.report(time.perf_counter() - start))
+    finally:
+        for process in processes:
+            process.terminate()
+
+if __name__ == '__main__':
+    main()
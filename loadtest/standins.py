@@ -0,0 +1,54 @@
+"""Runs one service on localhost with its neighbours pointed at localhost too, so the whole stack works offline.
+The mongo api gets an in-memory mongomock database instead of a mongo server.
+
+usage: python standins.py (dictionary|mongo_api|wordle) [--dictionary-port N] [--mongo-api-port N] [--wordle-port N]
+"""
+import argparse
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+default_ports = {"dictionary": 22122, "mongo_api": 22345, "wordle": 22347}
+
+
+def run_dictionary(args):
+    sys.path.insert(0, os.path.join(root, "dictionary"))
+    import dictionary
+    dictionary.dictionary_server_port = args.dictionary_port
+    dictionary.word_list_path = os.path.join(root, "dictionary", "words.txt")
+    dictionary.main()
+
+def run_mongo_api(args):
+    sys.path.insert(0, os.path.join(root, "mongodb"))
+    import mongomock #pip install mongomock
+    import mongo_client
+    database = mongomock.MongoClient()
+    mongo_client.MongoClient = lambda *args, **kwargs: database
+    mongo_client.mongo_api_port = args.mongo_api_port
+    mongo_client.login_limiter_by_address = mongo_client.RateLimiter(rate=1e6, burst=1e6) # every simulated player has the same address
+    mongo_client.main()
+
+def run_wordle(args):
+    sys.path.insert(0, os.path.join(root, "wordle"))
+    import wordle
+    wordle.wordle_port = args.wordle_port
+    wordle.mongo_api_ip = "127.0.0.1"
+    wordle.mongo_api_port = args.mongo_api_port
+    wordle.dictionary_server_ip = "127.0.0.1"
+    wordle.dictionary_server_port = args.dictionary_port
+    wordle.main()
+
+
+services = {"dictionary": run_dictionary, "mongo_api": run_mongo_api, "wordle": run_wordle}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("service", choices=services)
+    for service, port in default_ports.items():
+        parser.add_argument(f"--{service.replace('_', '-')}-port", type=int, default=port)
+    args = parser.parse_args()
+    services[args.service](args)
+
+if __name__ == '__main__':
+    main()
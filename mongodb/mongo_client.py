@@ -1,9 +1,29 @@
+import datetime
+import hashlib
+import heapq
+import hmac
 import json
+import logging
+import multiprocessing
+import os
 import socket
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import bcrypt #pip install bcrypt
-from pymongo import MongoClient, errors #pip install pymongo
+from pymongo import ASCENDING, DESCENDING, MongoClient, UpdateOne, errors, monitoring #pip install pymongo
+
+import metrics
+import protocol
+import tokens
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s %(message)s")
+logger = logging.getLogger("mongo_api")
+metrics.namespace = "mongo_api"
+metrics_port = int(os.environ.get("METRICS_PORT", "9102"))
 
 
 endpoints = {
@@ -22,77 +42,421 @@ endpoints = {
   "wordle": {
     "ip": 'wordle_container',
     "port": 12347
+  },
+  "router": {
+    "ip": 'wordle_router',
+    "port": 12347
   }
 }
+# a json file of the same shape in ENDPOINTS_FILE, then <NAME>_IP and <NAME>_PORT variables, override the defaults above
+if os.environ.get("ENDPOINTS_FILE"):
+    with open(os.environ["ENDPOINTS_FILE"]) as endpoints_file:
+        for name, endpoint in json.load(endpoints_file).items():
+            endpoints.setdefault(name, {}).update(endpoint)
+for name, endpoint in endpoints.items():
+    endpoint["ip"] = os.environ.get(f"{name.upper()}_IP", endpoint["ip"])
+    endpoint["port"] = int(os.environ.get(f"{name.upper()}_PORT", endpoint["port"]))
 db_endpoint = endpoints["mongo_db"]
 mongo_db_port = db_endpoint["port"]
 mongo_db_ip = db_endpoint["ip"]
-print(f"MongoDB: {mongo_db_ip}:{mongo_db_port}")
+logger.info("MongoDB: %s:%s", mongo_db_ip, mongo_db_port)
 
 mongo_api_endpoint = endpoints["mongo_api"]
 mongo_api_port = mongo_api_endpoint["port"]
 mongo_api_ip = mongo_api_endpoint["ip"]
-print(f"Mongo API: {mongo_api_ip}:{mongo_api_port}")
+logger.info("Mongo API: %s:%s", mongo_api_ip, mongo_api_port)
+
+
+request_workers = ThreadPoolExecutor(max_workers=int(os.environ.get("REQUEST_WORKERS", "32"))) # run the requests of multiplexed connections
+# the ones that wait for bcrypt run on workers of their own, so cheap requests never queue behind a burst of logins
+auth_workers = ThreadPoolExecutor(max_workers=int(os.environ.get("AUTH_WORKERS", "8")))
+auth_request_types = {"login", "register", "change_password"}
+
+def send_packet(client, packet):
+    """sends one packet to the caller of a request, in the encoding of its connection, packet may be already encoded"""
+    client.send(packet)
+
+
+session_ttl = float(os.environ.get("SESSION_TTL", str(24*3600)))
+
+
+class MemorySessionStore:
+    """Sessions of this process only, token: username with an expiry, plus username: tokens so per-user lookups don't scan"""
+    def __init__(self, ttl=session_ttl):
+        self.ttl = ttl
+        self.sessions = {} # token: (username, expires_at)
+        self.tokens_by_user = {} # username: {tokens}
+        self.expiry_heap = [] # (expires_at, token), soonest first
+        self.lock = threading.Lock()
+
+    def create(self, username):
+        token = str(uuid.uuid4())
+        expires_at = time.time() + self.ttl
+        with self.lock:
+            self.evict_expired()
+            self.sessions[token] = (username, expires_at)
+            self.tokens_by_user.setdefault(username, set()).add(token)
+            heapq.heappush(self.expiry_heap, (expires_at, token))
+        return token
+
+    def get(self, token):
+        """:returns: username of a live session, None if the token is unknown or expired"""
+        with self.lock:
+            session = self.sessions.get(token)
+            if session is None:
+                return None
+            if session[1] < time.time():
+                self.remove(token)
+                return None
+            return session[0]
+
+    def delete(self, token):
+        with self.lock:
+            self.remove(token)
+
+    def is_logged_in(self, username):
+        with self.lock:
+            return any(self.sessions[token][1] >= time.time() for token in self.tokens_by_user.get(username, ()))
+
+    def remove(self, token):
+        session = self.sessions.pop(token, None)
+        if session is None:
+            return
+        tokens = self.tokens_by_user[session[0]]
+        tokens.discard(token)
+        if not tokens:
+            del self.tokens_by_user[session[0]]
+
+    def evict_expired(self):
+        now = time.time()
+        while self.expiry_heap and self.expiry_heap[0][0] < now:
+            expires_at, token = heapq.heappop(self.expiry_heap)
+            session = self.sessions.get(token)
+            if session is not None and session[1] == expires_at:
+                self.remove(token)
+
+
+class MongoSessionStore:
+    """Sessions in a mongo TTL collection, shared by every mongo api replica"""
+    def __init__(self, collection, ttl=session_ttl):
+        self.collection = collection
+        self.ttl = ttl
+        self.collection.create_index("expires_at", expireAfterSeconds=0) # mongo deletes expired sessions itself
+        self.collection.create_index("username")
+
+    def create(self, username):
+        token = str(uuid.uuid4())
+        expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.ttl)
+        self.collection.insert_one({"_id": token, "username": username, "expires_at": expires_at})
+        return token
+
+    def get(self, token):
+        # the ttl monitor only runs once a minute, so expiry is checked here too
+        session = self.collection.find_one({"_id": token, "expires_at": {"$gt": datetime.datetime.utcnow()}}, {"username": True})
+        return None if session is None else session["username"]
+
+    def delete(self, token):
+        self.collection.delete_one({"_id": token})
+
+    def is_logged_in(self, username):
+        return self.collection.find_one({"username": username, "expires_at": {"$gt": datetime.datetime.utcnow()}}, {"_id": True}) is not None
+
+
+session_store_type = os.environ.get("SESSION_STORE", "memory") # "memory" or "mongo", mongo is needed to run several replicas
+session_store = MemorySessionStore()
+
+def issue_token(username):
+    """starts a session, :returns: its signed token, which the game servers check without asking us"""
+    session_id = session_store.create(username)
+    return tokens.sign(session_id, username, time.time() + session_ttl)
+
+def session_username(token):
+    """:returns: username logged in with this token, raises KeyError if it is forged, expired, or was logged out"""
+    claims = tokens.verify(token)
+    if claims is None:
+        raise KeyError(token)
+    session_id, username, _ = claims
+    if session_store.get(session_id) != username:
+        raise KeyError(token)
+    return username
 
+users = None
+games = None # one document per finished game, indexed on (username, timestamp)
+stats = None # one document of running totals per user, updated with every finished game
+active_games = None # the game each user has in progress, checkpointed by the game server after every guess
+daily_results = None # one document per user and day of the daily challenge, indexed on (date, score) for ranking
+daily_counts = None # players per (date, solved, guesses), so totals and ranks add up a few counters instead of counting results
+daily_second_counts = None # players per (date, solved, guesses, whole seconds taken), so a rank only counts the results of its own second
 
-sessions = {} # token: username
+active_game_ttl = float(os.environ.get("ACTIVE_GAME_TTL", str(7*24*3600))) # abandoned games are deleted after this long
 
-users = None
+history_page_size = 100
+max_history_page_size = 1000
+
+bcrypt_workers = int(os.environ.get("BCRYPT_WORKERS", os.cpu_count() or 1))
+bcrypt_pool = None # process pool for the deliberately slow hashing, so it doesn't hold up cheap db requests
+
+
+bcrypt_rounds = int(os.environ.get("BCRYPT_ROUNDS", "12")) # cost factor, each step doubles the time of a hash and a check
+
+
+def bcrypt_hash(password, rounds=12):
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds)).decode()
+def bcrypt_check(password, hashed):
+    return bcrypt.checkpw(password.encode(), hashed.encode())
+
+def hash_rounds(hashed):
+    """:returns: cost factor a bcrypt hash was made with, "$2b$12$..." """
+    return int(hashed.split("$")[2])
 
 def hash_password(password):
     try:
-        return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+        with metrics.timed("bcrypt_seconds", op="hash"):
+            return bcrypt_pool.submit(bcrypt_hash, password, bcrypt_rounds).result()
     except Exception as e:
-        print(f"Error hashing password: {e}")
+        logger.error("error hashing password: %r", e)
         return None
 def check_password(password, hashed):
+    if not isinstance(hashed, str): # a user stored without a hash can't log in
+        return False
     try:
-        return bcrypt.checkpw(password.encode(), hashed.encode())
+        with metrics.timed("bcrypt_seconds", op="check"):
+            return bcrypt_pool.submit(bcrypt_check, password, hashed).result()
     except Exception as e:
-        print("Error checking password: ", e)
+        logger.error("error checking password: %r", e)
         return False
 
+def rehash_password(username, password, old_hash):
+    """hashes the password again at the current cost in the background, unless it was changed meanwhile"""
+    def store(future):
+        try:
+            users.update_one({"username": username, "password": old_hash}, {"$set": {"password": future.result()}})
+            logger.info("rehashed the password of %s with cost %d", username, bcrypt_rounds)
+        except Exception as e:
+            logger.warning("could not rehash a password: %r", e)
+    bcrypt_pool.submit(bcrypt_hash, password, bcrypt_rounds).add_done_callback(store)
+
+
+class RateLimiter:
+    """One token bucket per key, refilled at rate tokens a second up to burst, for at most max_keys keys"""
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict() # key: [tokens, updated_at], least recently used first
+        self.lock = threading.Lock()
+
+    def allow(self, key) -> bool:
+        """takes a token from key's bucket, :returns: False if it is empty"""
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now]
+                while len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False) # the least recently used bucket, most likely refilled already
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                self.buckets.move_to_end(key)
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
+
+
+class CredentialCache:
+    """Passwords checked recently, so logging in again doesn't pay for bcrypt again.
+    Only a keyed sha256 of username, password and stored hash is kept, a changed password never matches"""
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.key = os.urandom(32) # never leaves the process, so the digests are useless anywhere else
+        self.entries = OrderedDict() # digest: expires_at, least recently used first
+        self.lock = threading.Lock()
+
+    def digest(self, username, password, hashed):
+        """:returns: None unless all three are strings, a user stored without a hash never matches"""
+        if not all(isinstance(part, str) for part in (username, password, hashed)):
+            return None
+        return hmac.new(self.key, "\0".join([username, password, hashed]).encode(), hashlib.sha256).digest()
+
+    def check(self, username, password, hashed) -> bool:
+        digest = self.digest(username, password, hashed)
+        if digest is None:
+            return False
+        with self.lock:
+            expires_at = self.entries.get(digest)
+            if expires_at is None or expires_at < time.time():
+                return False
+            self.entries.move_to_end(digest)
+            return True
+
+    def add(self, username, password, hashed):
+        digest = self.digest(username, password, hashed)
+        if digest is None:
+            return
+        with self.lock:
+            self.entries[digest] = time.time() + self.ttl
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+login_limiter_by_username = RateLimiter(float(os.environ.get("LOGIN_RATE_PER_USERNAME", "0.1")), float(os.environ.get("LOGIN_BURST_PER_USERNAME", "5")))
+login_limiter_by_address = RateLimiter(float(os.environ.get("LOGIN_RATE_PER_ADDRESS", "5")), float(os.environ.get("LOGIN_BURST_PER_ADDRESS", "50")))
+credential_cache = CredentialCache(int(os.environ.get("CREDENTIAL_CACHE_SIZE", "10000")), float(os.environ.get("CREDENTIAL_CACHE_TTL", "300")))
+
+def allow_login_attempt(user_info, client):
+    """:returns: False once the username or the player's address ran out of attempts, before any db or bcrypt work"""
+    address = user_info.get("client_address") # the game server passes on the player's address
+    if address is None:
+        try:
+            address = client.connection.sock.getpeername()[0]
+        except (OSError, AttributeError, IndexError):
+            address = None
+    if not login_limiter_by_username.allow(user_info["username"]):
+        metrics.inc("login_rate_limited_total", by="username")
+        return False
+    if address is not None and not login_limiter_by_address.allow(address):
+        metrics.inc("login_rate_limited_total", by="address")
+        return False
+    return True
+
+def send_rate_limited(client):
+    send_packet(client, {"packet_type": "response", "response": "too many login attempts, try again later"})
+
+class ResponseCache:
+    """LRU of encoded history and stats responses, bounded by their total size in bytes.
+    Every write to a user's games drops all of that user's entries, so a hit is always what mongo would say now,
+    as long as the writes go through this process, replicas should set a ttl"""
+    def __init__(self, max_bytes, ttl=0, max_writers=100000):
+        self.max_bytes = max_bytes
+        self.ttl = ttl # seconds, 0 keeps entries until they are evicted or invalidated
+        self.max_writers = max_writers
+        self.entries = OrderedDict() # (username, request..., encoding): (encoded response, expires_at), least recently used first
+        self.keys_by_user = {} # username: {keys}
+        self.writes = 0 # invalidations so far, a response read before one of its user's must not be cached after it
+        self.last_writes = OrderedDict() # username: self.writes after the user's last invalidation, oldest first
+        self.forgotten = 0 # the newest of those dropped from last_writes, every forgotten user counts as written then
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (self.ttl and entry[1] < time.time()):
+                if entry is not None:
+                    self.remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def generation(self):
+        """:returns: the stamp to pass to put() with the response read after this call"""
+        with self.lock:
+            return self.writes
+
+    def put(self, key, response, generation):
+        """caches response unless the user's games changed since generation() was read for it"""
+        if len(response) > self.max_bytes:
+            return
+        username = key[0]
+        with self.lock:
+            if generation < self.last_writes.get(username, self.forgotten):
+                return
+            self.remove(key)
+            self.entries[key] = (response, time.time() + self.ttl)
+            self.keys_by_user.setdefault(username, set()).add(key)
+            self.size += len(response)
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def invalidate(self, username):
+        with self.lock:
+            self.writes += 1
+            self.last_writes[username] = self.writes
+            self.last_writes.move_to_end(username)
+            while len(self.last_writes) > self.max_writers:
+                _, self.forgotten = self.last_writes.popitem(last=False)
+            for key in list(self.keys_by_user.get(username, ())):
+                self.remove(key)
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= len(entry[0])
+        keys = self.keys_by_user[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self.keys_by_user[key[0]]
+
+
+response_cache = ResponseCache(int(os.environ.get("RESPONSE_CACHE_BYTES", str(64 * 1024 * 1024))),
+                               ttl=float(os.environ.get("RESPONSE_CACHE_TTL", "0")))
+
+
 def clear_history(user_info, client):
     token = user_info["token"]
-    users.update_one({"username": sessions[token]}, {"$set": {"game_history": []}})
-    print("History cleared")
-    client.send(json.dumps({"packet_type": "response", "response": "success"}).encode())
+    username = session_username(token)
+    response_cache.invalidate(username)
+    result = games.delete_many({"username": username})
+    stats.delete_one({"username": username})
+    response_cache.invalidate(username) # again, a read that ran during the delete must not be cached
+    logger.debug("history cleared, games removed: %d", result.deleted_count)
+    send_packet(client, {"packet_type": "response", "response": "success"})
 
 def print_db(client):
     for db in client.list_databases():
-        print(db)
+        logger.info("database: %s", db)
 
 def add_user(username, password) -> bool:
     # Check if the username already exists
     if users.find_one({"username": username}):
-        print("Username already exists")
+        logger.debug("username already exists")
         return False  # Username already exists
-    response = users.insert_one({"username": username, "password": hash_password(password), "game_history": []})
-    print("User added to database")
+    hashed = hash_password(password)
+    if hashed is None:
+        return False
+    response = users.insert_one({"username": username, "password": hashed})
+    logger.debug("user added to database")
     return response.acknowledged  # returns true if the operation was successful
 
 
 def register(user_info, client):
     username = user_info["username"]
     password = user_info["password"]
-    print("request data: ", username, password)
+    logger.debug("register: %s", username)
+    if not allow_login_attempt(user_info, client):
+        send_rate_limited(client)
+        return
     if add_user(username, password) == True:
-        login(user_info, client)
+        found_user = users.find_one({"username": username})
+        credential_cache.add(username, password, found_user["password"]) # the login below needs no second bcrypt
+        login(user_info, client, rate_limited=False)
 
     else:
-        response_json = json.dumps({"packet_type": "error", "response": "could not add user to database"})
-        client.send(response_json.encode())
-        print("Register failed")
+        response = {"packet_type": "error", "response": "could not add user to database"}
+        send_packet(client, response)
+        logger.debug("register failed")
 
 def is_user_logged_in(username):
-    return username in sessions.values()
-def login(user_info, client):
+    return session_store.is_logged_in(username)
+def login(user_info, client, rate_limited=True):
     username = user_info["username"]
     password = user_info["password"]
-    print("request data: ", username, password)
+    logger.debug("login: %s", username)
+    if rate_limited and not allow_login_attempt(user_info, client):
+        send_rate_limited(client)
+        return
     #if is_user_logged_in(username):
     #    response_json = json.dumps({"packet_type": "response", "response": "user is already logged in"})
-    #    client.send(response_json.encode())
+    #    send_packet(client, response_json)
     #    print("Login failed: User is already logged in")
     #    return
 
@@ -101,35 +465,52 @@ def login(user_info, client):
 
     if found_user is not None:
         password_hash = found_user["password"]
-        if check_password(password, password_hash):
-            token = str(uuid.uuid4())
-            sessions[token] = username
-            response_json = json.dumps({"packet_type": "response", "response": "success", "token": token})
-            client.send(response_json.encode())
-            print("Login success")
+        if credential_cache.check(username, password, password_hash):
+            metrics.inc("credential_cache_hits_total")
+            verified = True
+        else:
+            verified = check_password(password, password_hash)
+            if verified:
+                credential_cache.add(username, password, password_hash)
+        if verified:
+            if hash_rounds(password_hash) != bcrypt_rounds:
+                rehash_password(username, password, password_hash)
+            token = issue_token(username)
+            response = {"packet_type": "response", "response": "success", "token": token}
+            send_packet(client, response)
+            logger.debug("login success")
             return
 
-    response_json = json.dumps({"packet_type": "response", "response": "user does not exist, or password is wrong"})
-    client.send(response_json.encode())
-    print("Login failed")
+    response = {"packet_type": "response", "response": "user does not exist, or password is wrong"}
+    send_packet(client, response)
+    logger.debug("login failed")
 
 def get_history(user_info, client):
+    """sends one page of the user's games, newest first, pass "before" from the previous page to get the next one"""
     try:
         token = user_info["token"]
-        username = sessions[token]
-        user = users.find_one({"username": username})
-        if user is None:
-            response_json = json.dumps({"packet_type": "error", "response": "invalid token"})
-            client.send(response_json.encode())
-            print("Get stats failed: Invalid token")
+        username = session_username(token)
+        limit = max(1, min(int(user_info.get("limit", history_page_size)), max_history_page_size)) # pymongo reads limit(0) as no limit
+        key = (username, "history", user_info.get("before"), limit, client.encoding)
+        cached = response_cache.get(key)
+        if cached is not None:
+            send_packet(client, cached)
             return
-        history = user["game_history"]
-        response_json = json.dumps({"packet_type": "history", "response": "success", "history": history})
-        client.send(response_json.encode())
+        generation = response_cache.generation()
+        query = {"username": username}
+        if user_info.get("before") is not None:
+            query["timestamp"] = {"$lt": user_info["before"]}
+
+        page = games.find(query, {"_id": False, "username": False, "stats_pending": False}).sort("timestamp", DESCENDING).limit(limit)
+        history = list(page)
+        next_before = history[-1]["timestamp"] if len(history) == limit else None
+        response = protocol.encode({"packet_type": "history", "response": "success", "history": history, "next_before": next_before}, client.encoding)
+        response_cache.put(key, response, generation)
+        send_packet(client, response)
     except KeyError as e:
-        print("Get stats failed: ", e)
-        response_json = json.dumps({"packet_type": "error", "response": "json error"})
-        client.send(response_json.encode())
+        logger.debug("get stats failed: %r", e)
+        response = {"packet_type": "error", "response": "json error"}
+        send_packet(client, response)
 
 
 
@@ -141,89 +522,444 @@ def add_history(request, client):
     try:
         if token is not None:
             try:
-                username = sessions[token]
+                username = session_username(token)
             except KeyError:
                 raise ValueError("Could not authenticate user")
-            users.update_one({"username": username}, {"$push": {"game_history": game_data}})
+            record_games([{"username": username, "timestamp": time.time(), **game_data}])
 
-            response_json = json.dumps({"packet_type": "response", "response": "success"})
-            client.send(response_json.encode())
-            print("Game stats added")
+            response = {"packet_type": "response", "response": "success"}
+            send_packet(client, response)
+            logger.debug("game stats added")
         else:
-            response_json = json.dumps({"packet_type": "error", "response": "invalid token"})
-            client.send(response_json.encode())
-            print("Add stats failed: Invalid token")
+            response = {"packet_type": "error", "response": "invalid token"}
+            send_packet(client, response)
+            logger.debug("add stats failed: invalid token")
     except ValueError as e:
-        print("Add history failed: ", e)
-        response_json = json.dumps({"packet_type": "error", "response": str(e)})
-        client.send(response_json.encode())
+        logger.debug("add history failed: %s", e)
+        response = {"packet_type": "error", "response": str(e)}
+        send_packet(client, response)
+
+
+def add_history_bulk(request, client):
+    """records a batch of finished games from the game server's write-behind queue,
+    games whose token is no longer valid are counted as rejected, games already recorded by an earlier retry are skipped"""
+    documents = []
+    rejected = 0
+    for game in request["games"]:
+        try:
+            username = session_username(game["token"])
+        except KeyError:
+            rejected += 1
+            continue
+        documents.append({"_id": game["id"], "username": username, "timestamp": game["timestamp"], **game["data"]})
+    inserted = record_games(documents)
+    response = {"packet_type": "response", "response": "success", "inserted": len(inserted), "rejected": rejected}
+    send_packet(client, response)
+    logger.debug("batch of %d games, inserted %d, rejected %d", len(request["games"]), len(inserted), rejected)
+
+def record_games(documents):
+    """inserts the games and adds them to their players' stats, one bulk write per collection, :returns: the newly inserted games.
+    A game is inserted with stats_pending set until its stats are written, so a retry of a batch whose stats write failed
+    counts the games the first try inserted, and only those"""
+    if not documents:
+        return []
+    for username in {document["username"] for document in documents}:
+        response_cache.invalidate(username)
+    for document in documents:
+        document["stats_pending"] = True
+    try:
+        games.insert_many(documents, ordered=False)
+        inserted = documents
+        uncounted = documents
+    except errors.BulkWriteError as e:
+        write_errors = e.details["writeErrors"]
+        if any(error["code"] != 11000 for error in write_errors):
+            raise
+        duplicates = {error["index"] for error in write_errors}
+        inserted = [document for i, document in enumerate(documents) if i not in duplicates]
+        pending = {game["_id"] for game in games.find({"_id": {"$in": [documents[i]["_id"] for i in duplicates]}, "stats_pending": True}, {"_id": True})}
+        uncounted = [document for i, document in enumerate(documents) if i not in duplicates or document["_id"] in pending]
+    if uncounted:
+        # ordered, so the streaks of a player with several games in the batch are applied in order
+        stats.bulk_write([UpdateOne({"username": document["username"]}, stats_update(document["game_data"]["win"], len(document["game_data"]["guesses"])), upsert=True)
+                          for document in uncounted], ordered=True)
+        games.update_many({"_id": {"$in": [document["_id"] for document in uncounted]}}, {"$unset": {"stats_pending": ""}})
+    for username in {document["username"] for document in documents}:
+        response_cache.invalidate(username) # again, a read that ran during the writes must not be cached
+    return inserted
+
+
+def stats_update(win, guesses_count):
+    """:returns: update pipeline that adds one game to a stats document in a single atomic write"""
+    def counter(field):
+        return {"$ifNull": [f"${field}", 0]}
+    current_streak = {"$add": [counter("current_streak"), 1]} if win else 0
+    fields = {
+        "games": {"$add": [counter("games"), 1]},
+        "wins": {"$add": [counter("wins"), 1 if win else 0]},
+        "current_streak": current_streak,
+        "max_streak": {"$max": [counter("max_streak"), current_streak]},
+    }
+    if win:
+        fields[f"guess_distribution.{guesses_count}"] = {"$add": [counter(f"guess_distribution.{guesses_count}"), 1]}
+    return [{"$set": fields}]
+
+def update_stats(username, game_data):
+    stats.update_one({"username": username}, stats_update(game_data["win"], len(game_data["guesses"])), upsert=True)
+
+def get_stats(user_info, client):
+    try:
+        token = user_info["token"]
+        username = session_username(token)
+        key = (username, "stats", client.encoding)
+        cached = response_cache.get(key)
+        if cached is not None:
+            send_packet(client, cached)
+            return
+        generation = response_cache.generation()
+        user_stats = stats.find_one({"username": username}, {"_id": False, "username": False}) or {}
+        total_games = user_stats.get("games", 0)
+        wins = user_stats.get("wins", 0)
+        response = protocol.encode({"packet_type": "stats", "response": "success", "stats": {
+            "total_games": total_games,
+            "wins": wins,
+            "losses": total_games - wins,
+            "win_rate": wins / total_games if total_games > 0 else 0,
+            "current_streak": user_stats.get("current_streak", 0),
+            "max_streak": user_stats.get("max_streak", 0),
+            "guess_distribution": user_stats.get("guess_distribution", {}),
+        }}, client.encoding)
+        response_cache.put(key, response, generation)
+        send_packet(client, response)
+    except KeyError as e:
+        logger.debug("get stats failed: %r", e)
+        response = {"packet_type": "error", "response": "json error"}
+        send_packet(client, response)
+
+
+def migrate_game_history():
+    """moves games still embedded in user documents into the games collection"""
+    for user in users.find({"game_history": {"$exists": True}}, {"username": True, "game_history": True}):
+        old_games = user["game_history"]
+        if old_games:
+            # the old array kept no timestamps, its order is all we know
+            games.insert_many([{"username": user["username"], "timestamp": float(i), **game} for i, game in enumerate(old_games)])
+            for game in old_games:
+                update_stats(user["username"], game["game_data"])
+        users.update_one({"_id": user["_id"]}, {"$unset": {"game_history": ""}})
+        logger.info("migrated %d games of %s", len(old_games), user["username"])
+
+
+def migrate_daily_counts():
+    """counts the daily results stored before there were counters"""
+    if daily_results.find_one() is None:
+        return
+    if daily_counts.find_one() is None:
+        grouped = daily_results.aggregate([{"$group": {"_id": {"date": "$date", "solved": "$solved", "guesses": "$guesses"}, "count": {"$sum": 1}}}])
+        daily_counts.insert_many([{**bucket["_id"], "count": bucket["count"]} for bucket in grouped])
+        logger.info("counted the daily results of earlier days")
+    if daily_second_counts.find_one() is None:
+        counts = {}
+        for result in daily_results.find({}, {"date": True, "solved": True, "guesses": True, "seconds": True}):
+            key = (result["date"], result["solved"], result["guesses"], daily_second(result["seconds"]))
+            counts[key] = counts.get(key, 0) + 1
+        daily_second_counts.insert_many([{"date": date, "solved": solved, "guesses": guesses, "second": second, "count": count}
+                                         for (date, solved, guesses, second), count in counts.items()])
+        logger.info("counted the daily results of earlier days by second")
+
+
+def checkpoint_id(username, daily):
+    """a user has one random game checkpoint, and one per day of the daily challenge, so a random game can't replace the daily one"""
+    return {"username": username, "daily": daily} if daily else username
+
+def save_game(request, client):
+    """checkpoints the user's game in progress, replacing the one of the same kind saved before"""
+    username = session_username(request["token"])
+    expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=active_game_ttl)
+    active_games.replace_one({"_id": checkpoint_id(username, request["game"].get("daily"))},
+                             {"game": request["game"], "expires_at": expires_at}, upsert=True)
+    send_packet(client, {"packet_type": "response", "response": "success"})
+
+def load_game(request, client):
+    """sends the user's random game checkpoint, or with "daily" the one of that day, refused once the day's result is in"""
+    username = session_username(request["token"])
+    daily = request.get("daily")
+    if daily and daily_results.find_one({"date": daily, "username": username}, {"_id": True}) is not None:
+        send_packet(client, {"packet_type": "error", "response": "already played today", "played": True})
+        return
+    saved = active_games.find_one({"_id": checkpoint_id(username, daily), "expires_at": {"$gt": datetime.datetime.utcnow()}})
+    if saved is None:
+        send_packet(client, {"packet_type": "error", "response": "no game to resume"})
+        return
+    send_packet(client, {"packet_type": "response", "response": "success", "game": saved["game"]})
+
+def delete_game(request, client):
+    """removes the checkpoint of a finished game, unless the user already started another one"""
+    username = session_username(request["token"])
+    active_games.delete_one({"_id": checkpoint_id(username, request.get("daily")), "game.id": request["game_id"]})
+    send_packet(client, {"packet_type": "response", "response": "success"})
+
+
+leaderboard_size = 10
+max_leaderboard_size = 100
+
+def daily_score(solved, guesses_count, seconds):
+    """:returns: one number to rank daily results by, lower is better: solved first, then fewer guesses, then faster"""
+    return (0 if solved else 1) * 1e12 + guesses_count * 1e9 + min(seconds, 1e9 - 1)
+
+def daily_buckets(date):
+    """:returns: players of one day by result, {(solved, guesses): count}, a few dozen counters at most"""
+    return {(bucket["solved"], bucket["guesses"]): bucket["count"] for bucket in daily_counts.find({"date": date})}
+
+def daily_second(seconds):
+    return int(min(seconds, 1e9 - 1))
+
+def daily_rank(date, solved, guesses_count, seconds, score, buckets):
+    """1 + the results with a better score: the counters of the better buckets, the per second counters of the same bucket
+    up to the player's second, one per second played, and the faster results of that second, counted on the (date, score) index.
+    So the cost grows with how long games take, not with how many played"""
+    bucket_score = daily_score(solved, guesses_count, 0)
+    better = sum(count for (bucket_solved, bucket_guesses), count in buckets.items() if daily_score(bucket_solved, bucket_guesses, 0) < bucket_score)
+    second = daily_second(seconds)
+    better += sum(counter["count"] for counter in daily_second_counts.find(
+        {"date": date, "solved": solved, "guesses": guesses_count, "second": {"$lt": second}}, {"count": True}))
+    return better + daily_results.count_documents({"date": date, "score": {"$gte": bucket_score + second, "$lt": score}}) + 1
+
+def add_daily_result(request, client):
+    username = session_username(request["token"])
+    date = request["date"]
+    score = daily_score(request["solved"], request["guesses"], request["seconds"])
+    try:
+        daily_results.insert_one({"date": date, "username": username, "solved": request["solved"],
+                                  "guesses": request["guesses"], "seconds": request["seconds"], "score": score})
+    except errors.DuplicateKeyError:
+        send_packet(client, {"packet_type": "error", "response": "already played today"})
+        return
+    daily_counts.update_one({"date": date, "solved": request["solved"], "guesses": request["guesses"]}, {"$inc": {"count": 1}}, upsert=True)
+    daily_second_counts.update_one({"date": date, "solved": request["solved"], "guesses": request["guesses"], "second": daily_second(request["seconds"])},
+                                   {"$inc": {"count": 1}}, upsert=True)
+    buckets = daily_buckets(date)
+    send_packet(client, {"packet_type": "response", "response": "success",
+                                    "rank": daily_rank(date, request["solved"], request["guesses"], request["seconds"], score, buckets),
+                                    "players": sum(buckets.values())})
+
+def get_leaderboard(request, client):
+    """sends the best results of one day in order, and the caller's own result and rank if they played"""
+    username = session_username(request["token"])
+    date = request["date"]
+    limit = min(int(request.get("limit", leaderboard_size)), max_leaderboard_size)
+    fields = {"_id": False, "username": True, "solved": True, "guesses": True, "seconds": True, "score": True}
+    top = list(daily_results.find({"date": date}, fields).sort("score", ASCENDING).limit(limit)) if limit > 0 else []
+    for i, entry in enumerate(top):
+        entry["rank"] = top[i - 1]["rank"] if i > 0 and entry["score"] == top[i - 1]["score"] else i + 1 # ties share a rank
+    me = daily_results.find_one({"date": date, "username": username}, fields)
+    buckets = daily_buckets(date)
+    if me is not None:
+        me["rank"] = daily_rank(date, me["solved"], me["guesses"], me["seconds"], me["score"], buckets)
+    send_packet(client, {"packet_type": "leaderboard", "response": "success", "date": date, "top": top, "me": me,
+                                    "players": sum(buckets.values())})
+
+
+def logout(user_info, client):
+    claims = tokens.verify(user_info["token"])
+    if claims is not None:
+        session_store.delete(claims[0])
+    send_packet(client, {"packet_type": "response", "response": "success"})
+    logger.debug("logged out")
 
 
 def change_password(user_info, client):
     token = user_info["token"]
-    username = sessions[token]
+    username = session_username(token)
     new_password = user_info["new_password"]
-    result = users.update_one({"username": username}, {"$set": {"password": hash_password(new_password)}})
-    print("Password changed, result: ", result)
+    hashed = hash_password(new_password)
+    if hashed is None: # storing it would lock the user out
+        send_packet(client, {"packet_type": "error", "response": "could not change password"})
+        return
+    result = users.update_one({"username": username}, {"$set": {"password": hashed}})
+    logger.debug("password changed, result: %s", result)
     if result.acknowledged:
-        response_json = json.dumps({"packet_type": "response", "response": "success"})
-        client.send(response_json.encode())
+        response = {"packet_type": "response", "response": "success"}
+        send_packet(client, response)
+
+
+
+request_types = {"login", "register", "add_history", "add_history_bulk", "get_history", "get_stats", "clear_history", "change_password", "logout",
+                 "save_game", "load_game", "delete_game", "add_daily_result", "get_leaderboard"}
+
+def handle_request(client, request_data):
+    """request_data is the request as received, or already decoded"""
+    data = request_data if isinstance(request_data, dict) else protocol.decode(request_data, client.encoding)
+    packet_type = data["packet_type"]
+    if packet_type == "hello":
+        client.connection.accept_hello(data, client.request_id)
+        return
+
+    logger.debug("request type: %s", packet_type)
+    label = packet_type if packet_type in request_types else "invalid"
+    metrics.inc("requests_total", packet_type=label)
+    with metrics.timed("request_seconds", packet_type=label):
+        dispatch_request(client, data, packet_type)
+
+def dispatch_request(client, data, packet_type):
+    if packet_type == "login":
+        login(data, client)
+    elif packet_type == "register":
+        register(data, client)
+    elif packet_type == "add_history":
+        add_history(data, client)
+    elif packet_type == "add_history_bulk":
+        add_history_bulk(data, client)
+    elif packet_type == "get_history":
+        get_history(data, client)
+    elif packet_type == "get_stats":
+        get_stats(data, client)
+    elif packet_type == "clear_history":
+        clear_history(data, client,)
+    elif packet_type == "change_password":
+        change_password(data, client)
+    elif packet_type == "logout":
+        logout(data, client)
+    elif packet_type == "save_game":
+        save_game(data, client)
+    elif packet_type == "load_game":
+        load_game(data, client)
+    elif packet_type == "delete_game":
+        delete_game(data, client)
+    elif packet_type == "add_daily_result":
+        add_daily_result(data, client)
+    elif packet_type == "get_leaderboard":
+        get_leaderboard(data, client)
+    else:
+        logger.debug("invalid request")
+        send_packet(client, {"packet_type": "error", "response": "invalid request"})
+
+def serve_request(client, request_data):
+    try:
+        handle_request(client, request_data)
+    except (socket.timeout, errors.PyMongoError) as e:
+        logger.warning("mongo request failed: %r", e)
+        send_packet(client, {"packet_type": "error", "response": "database unavailable"})
+    except (KeyError, ValueError) as e: # json and msgpack decoding errors are ValueErrors
+        logger.warning("invalid request: %r", e)
+        send_packet(client, {"packet_type": "error", "response": "invalid request"})
+    except OSError: # the caller left, nothing to answer
+        raise
+    except Exception: # a caller on a multiplexed connection would wait for an answer forever
+        logger.exception("request failed")
+        send_packet(client, {"packet_type": "error", "response": "internal error"})
+
+def serve_request_in_worker(client, request_data):
+    try:
+        serve_request(client, request_data)
+    except OSError as e: # the caller left before the response
+        logger.info("connection lost: %r", e)
 
+def decode_for_workers(connection, request_data):
+    """:returns: the workers to run a multiplexed request on, and the request decoded, or as received if it doesn't decode"""
+    try:
+        data = protocol.decode(request_data, connection.encoding)
+    except Exception: # its worker answers that it is invalid
+        return request_workers, request_data
+    if isinstance(data, dict) and data.get("packet_type") in auth_request_types:
+        return auth_workers, data
+    return request_workers, data
+
+def client_thread(client):
+    """serves requests from one connection until the peer closes it, so the game server can keep a pool of open connections,
+    the requests of a multiplexed connection run side by side on the request workers, or the auth workers"""
+    connection = protocol.ServiceConnection(client)
+    try:
+        while True:
+            request = connection.receive()
+            if request is None:
+                break
+            request_id, request_data = request
+            if connection.multiplex:
+                workers, request_data = decode_for_workers(connection, request_data)
+                workers.submit(serve_request_in_worker, protocol.Reply(connection, request_id), request_data)
+            else:
+                serve_request(protocol.Reply(connection), request_data)
+    except (ConnectionResetError, BrokenPipeError) as e:
+        logger.info("connection lost: %r", e)
+    finally:
+        client.close()
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """times every command the driver sends to mongo"""
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics.observe("mongo_command_seconds", event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        metrics.inc("mongo_command_errors_total", command=event.command_name)
+        metrics.observe("mongo_command_seconds", event.duration_micros / 1e6, command=event.command_name)
 
 
 def main():
+    global bcrypt_pool
+    metrics.serve(metrics_port)
+    metrics.gauge("response_cache_hits", lambda: response_cache.hits)
+    metrics.gauge("response_cache_misses", lambda: response_cache.misses)
+    metrics.gauge("response_cache_bytes", lambda: response_cache.size)
+    if tokens.is_default_secret():
+        logger.warning("TOKEN_SECRET is not set, tokens are signed with an insecure default")
+    # spawned rather than forked, the workers must not inherit the mongo client's threads and sockets
+    bcrypt_pool = ProcessPoolExecutor(max_workers=bcrypt_workers, mp_context=multiprocessing.get_context("spawn"))
+    logger.info("bcrypt workers: %d", bcrypt_workers)
+
     while True:
         try:
-            print("connecting to mongo")
-            client = MongoClient(mongo_db_ip, port=mongo_db_port, username='mongoadmin', password='hunter2', connectTimeoutMS=5000, socketTimeoutMS=5000, authSource="admin")
+            logger.info("connecting to mongo")
+            client = MongoClient(mongo_db_ip, port=mongo_db_port, username='mongoadmin', password='hunter2', connectTimeoutMS=5000, socketTimeoutMS=5000, authSource="admin", event_listeners=[MongoCommandMetrics()])
 
             wordle_db = client.wordle_db
-            print(wordle_db)
+            logger.info("database: %s", wordle_db)
 
             server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # a restart binds while the last run's connections are in TIME_WAIT
             server.bind(("0.0.0.0", mongo_api_port))
             server.listen()
 
             test_connection = client.server_info()
-            print("Connected to mongo: ", test_connection)
-            global users
+            logger.info("connected to mongo, version %s", test_connection.get("version"))
+            global users, games, stats, active_games, daily_results, daily_counts, daily_second_counts, session_store
             users = wordle_db.users
+            games = wordle_db.games
+            games.create_index([("username", ASCENDING), ("timestamp", DESCENDING)])
+            stats = wordle_db.stats
+            stats.create_index("username", unique=True)
+            active_games = wordle_db.active_games # keyed by username, and by username and date for daily games
+            active_games.create_index("expires_at", expireAfterSeconds=0)
+            daily_results = wordle_db.daily_results
+            daily_results.create_index([("date", ASCENDING), ("username", ASCENDING)], unique=True) # one try per day
+            daily_results.create_index([("date", ASCENDING), ("score", ASCENDING)])
+            daily_counts = wordle_db.daily_counts
+            daily_counts.create_index([("date", ASCENDING), ("solved", ASCENDING), ("guesses", ASCENDING)], unique=True)
+            daily_second_counts = wordle_db.daily_second_counts
+            daily_second_counts.create_index([("date", ASCENDING), ("solved", ASCENDING), ("guesses", ASCENDING), ("second", ASCENDING)], unique=True)
+            if session_store_type == "mongo":
+                session_store = MongoSessionStore(wordle_db.sessions)
+            migrate_game_history()
+            migrate_daily_counts()
             break
 
         except errors.ServerSelectionTimeoutError as e:
-            print("Could not connect to mongo: ", e)
+            logger.warning("could not connect to mongo: %r", e)
 
 
     while True:
         try:
-            print("Database client is waiting for connections...")
+            logger.debug("waiting for connections")
 
             client, addr = server.accept()
-            print("Connection from: ", addr)
-
-            request_json = client.recv(4096).decode()
-            data = json.loads(request_json)
-            packet_type = data["packet_type"]
-
-            print(f"Request type: \"{packet_type}\"")
-
-            if packet_type == "login":
-                login(data, client)
-            elif packet_type == "register":
-                register(data, client)
-            elif packet_type == "add_history":
-                add_history(data, client)
-            elif packet_type == "get_history":
-                get_history(data, client)
-            elif packet_type == "clear_history":
-                clear_history(data, client,)
-            elif packet_type == "change_password":
-                change_password(data, client)
-            else:
-                print("invalid request")
-                client.send(json.dumps({"packet_type": "error", "response": "invalid request"}).encode())
-        except (socket.timeout, errors.ServerSelectionTimeoutError) as e:
-            print("Could not connect to mongo: ", e)
+            logger.debug("connection from %s", addr)
+            threading.Thread(target=client_thread, args=(client,), daemon=True).start()
+        except OSError as e:
+            logger.warning("accept failed: %r", e)
 
 
 
@@ -0,0 +1,41 @@
+import base64
+import hashlib
+import hmac
+import os
+import time
+
+# A session token is "<session id>.<username>.<expiry>.<signature>", signed with a secret every service shares,
+# so any service can tell who sent a request without asking the session store.
+# Every service has its own copy of this file, like it has its own copy of the endpoints.
+
+default_secret = "insecure-development-secret"
+secret = os.environ.get("TOKEN_SECRET", default_secret).encode() # set the same TOKEN_SECRET on the mongo api and game servers
+
+
+def encode(text):
+    return base64.urlsafe_b64encode(text.encode()).rstrip(b"=").decode()
+
+def decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4)).decode()
+
+def signature(payload):
+    return base64.urlsafe_b64encode(hmac.new(secret, payload.encode(), hashlib.sha256).digest()).rstrip(b"=").decode()
+
+def sign(session_id, username, expires_at) -> str:
+    payload = f"{session_id}.{encode(username)}.{int(expires_at)}"
+    return f"{payload}.{signature(payload)}"
+
+def verify(token):
+    """:returns: (session id, username, expires_at) of a token signed with our secret that hasn't expired, None otherwise"""
+    if not isinstance(token, str) or token.count(".") != 3:
+        return None
+    payload, token_signature = token.rsplit(".", 1)
+    if not hmac.compare_digest(token_signature.encode(), signature(payload).encode()):
+        return None
+    session_id, username, expires_at = payload.split(".")
+    if not expires_at.isdigit() or int(expires_at) < time.time():
+        return None
+    return session_id, decode(username), int(expires_at)
+
+def is_default_secret():
+    return secret == default_secret.encode()
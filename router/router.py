@@ -0,0 +1,273 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import os
+import signal
+
+import metrics
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s %(message)s")
+logger = logging.getLogger("router")
+metrics.namespace = "router"
+metrics_port = int(os.environ.get("METRICS_PORT", "9104"))
+
+endpoints = {
+  "dictionary": {
+    "ip": 'dictionary_container',
+    "port": 12122
+  },
+  "mongo_db": {
+    "ip": 'mongo_wordle',
+    "port": 27017
+  },
+  "mongo_api": {
+    "ip": 'mongo_client_container',
+    "port": 12345
+  },
+  "wordle": {
+    "ip": 'wordle_container',
+    "port": 12347
+  },
+  "router": {
+    "ip": 'wordle_router',
+    "port": 12347
+  }
+}
+# a json file of the same shape in ENDPOINTS_FILE, then <NAME>_IP and <NAME>_PORT variables, override the defaults above
+if os.environ.get("ENDPOINTS_FILE"):
+    with open(os.environ["ENDPOINTS_FILE"]) as endpoints_file:
+        for name, endpoint in json.load(endpoints_file).items():
+            endpoints.setdefault(name, {}).update(endpoint)
+for name, endpoint in endpoints.items():
+    endpoint["ip"] = os.environ.get(f"{name.upper()}_IP", endpoint["ip"])
+    endpoint["port"] = int(os.environ.get(f"{name.upper()}_PORT", endpoint["port"]))
+
+router_port = endpoints["router"]["port"]
+# game servers to spread players over, "host:port,host:port", a single one at the wordle endpoint by default
+wordle_instances = os.environ.get("WORDLE_INSTANCES", f"{endpoints['wordle']['ip']}:{endpoints['wordle']['port']}")
+
+routing = os.environ.get("ROUTING", "least_connections") # or "consistent_hash", which sends a username to the same server every time
+health_check_interval = float(os.environ.get("HEALTH_CHECK_INTERVAL", "2.0")) # seconds
+health_check_timeout = 1.0
+unhealthy_after = int(os.environ.get("UNHEALTHY_AFTER", "2")) # failed checks in a row
+drain_timeout = float(os.environ.get("DRAIN_TIMEOUT", "30")) # seconds players get to finish when the router stops
+ring_replicas = 100 # points of every server on the hash ring, so players spread evenly
+
+max_packet_size = 16 * 1024 * 1024
+
+async def write_packet(writer, packet):
+    """sends one json packet prefixed with its 4-byte length, so the receiver knows where it ends"""
+    data = packet.encode()
+    writer.write(len(data).to_bytes(4, "big") + data)
+    await writer.drain()
+
+async def read_frame(reader):
+    """:returns: the next packet with its length prefix, as received, or empty bytes if the peer closed the connection"""
+    try:
+        header = await reader.readexactly(4)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return b""
+        raise ConnectionResetError("connection closed mid-packet")
+    size = int.from_bytes(header, "big")
+    if size > max_packet_size:
+        raise ValueError(f"packet of {size} bytes is too large")
+    try:
+        return header + await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        raise ConnectionResetError("connection closed mid-packet")
+
+
+class Backend:
+    def __init__(self, address):
+        host, port = address.rsplit(":", 1)
+        self.host = host
+        self.port = int(port)
+        self.name = address
+        self.connections = 0
+        self.healthy = True # until a check says otherwise, so the first players don't wait for one
+        self.failures = 0
+
+    def mark_failed(self):
+        self.failures += 1
+        if self.healthy and self.failures >= unhealthy_after:
+            self.healthy = False
+            logger.warning("%s is unhealthy, no new players go there", self.name)
+
+    def mark_healthy(self):
+        if not self.healthy:
+            logger.info("%s is healthy again", self.name)
+        self.failures = 0
+        self.healthy = True
+
+    async def check(self):
+        """a game server that is draining has closed its listening socket, so a refused connection covers both"""
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), health_check_timeout)
+            writer.close()
+            self.mark_healthy()
+        except (OSError, asyncio.TimeoutError):
+            self.mark_failed()
+
+
+class Router:
+    def __init__(self, addresses):
+        self.backends = [Backend(address) for address in addresses]
+        self.ring = sorted((ring_hash(f"{backend.name}#{i}"), backend) for backend in self.backends for i in range(ring_replicas))
+        self.ring_keys = [key for key, _ in self.ring]
+        self.next_tie = 0
+
+    def least_connections(self, candidates):
+        fewest = min(backend.connections for backend in candidates)
+        tied = [backend for backend in candidates if backend.connections == fewest]
+        self.next_tie += 1
+        return tied[self.next_tie % len(tied)]
+
+    def by_username(self, username, candidates):
+        """the first server clockwise of the username on the ring, skipping the ones that can't take players"""
+        start = bisect.bisect(self.ring_keys, ring_hash(username))
+        for i in range(len(self.ring)):
+            backend = self.ring[(start + i) % len(self.ring)][1]
+            if backend in candidates:
+                return backend
+        return None
+
+    def choose(self, username=None, exclude=()):
+        candidates = [backend for backend in self.backends if backend.healthy and backend not in exclude]
+        if not candidates:
+            return None
+        if routing == "consistent_hash" and username is not None:
+            return self.by_username(username, candidates)
+        return self.least_connections(candidates)
+
+    async def health_checks(self):
+        while True:
+            await asyncio.gather(*(backend.check() for backend in self.backends))
+            await asyncio.sleep(health_check_interval)
+
+
+def ring_hash(text):
+    return int.from_bytes(hashlib.sha1(text.encode()).digest()[:8], "big")
+
+def login_username(frame):
+    """:returns: username of the player's first packet, None if it has none"""
+    try:
+        username = json.loads(frame[4:].decode()).get("username")
+    except (ValueError, UnicodeDecodeError, AttributeError):
+        return None
+    return username if isinstance(username, str) else None
+
+def with_client_address(frame, address):
+    """adds the player's address to the login packet, the game server only sees ours"""
+    try:
+        packet = json.loads(frame[4:].decode())
+    except (ValueError, UnicodeDecodeError):
+        return frame
+    if not isinstance(packet, dict):
+        return frame
+    packet["forwarded_for"] = address
+    data = json.dumps(packet).encode()
+    return len(data).to_bytes(4, "big") + data
+
+
+router = None
+active_connections = 0
+
+
+async def pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        writer.close()
+
+async def connect_backend(username):
+    """:returns: the chosen backend and a connection to it, trying the next one if a server refuses, (None, None) if none is left"""
+    tried = []
+    while True:
+        backend = router.choose(username, exclude=tried)
+        if backend is None:
+            return None, None
+        try:
+            connection = await asyncio.wait_for(asyncio.open_connection(backend.host, backend.port), health_check_timeout * 5)
+            return backend, connection
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.warning("could not connect to %s: %r", backend.name, e)
+            backend.mark_failed()
+            tried.append(backend)
+
+async def handle_player(reader, writer):
+    """picks a game server from the player's login packet, then passes bytes both ways until one side closes"""
+    global active_connections
+    active_connections += 1
+    backend = None
+    try:
+        first_frame = await read_frame(reader)
+        if not first_frame:
+            return
+        backend, connection = await connect_backend(login_username(first_frame))
+        if backend is None:
+            metrics.inc("connections_rejected_total")
+            await write_packet(writer, json.dumps({"packet_type": "response", "response": "no game server available, try again later"}))
+            return
+        backend_reader, backend_writer = connection
+        backend.connections += 1
+        metrics.inc("connections_total", backend=backend.name)
+        peer = writer.get_extra_info("peername")
+        backend_writer.write(with_client_address(first_frame, peer[0] if peer else None))
+        await backend_writer.drain()
+        await asyncio.gather(pipe(reader, backend_writer), pipe(backend_reader, writer))
+    except (ConnectionError, OSError, ValueError, asyncio.TimeoutError) as e:
+        logger.info("connection lost: %r", e)
+    finally:
+        if backend is not None:
+            backend.connections -= 1
+        active_connections -= 1
+        writer.close()
+
+async def drain(timeout):
+    """waits until every player left, or timeout seconds"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while active_connections and loop.time() < deadline:
+        await asyncio.sleep(0.5)
+
+async def serve():
+    global router
+    router = Router([address.strip() for address in wordle_instances.split(",") if address.strip()])
+    logger.info("routing to %s by %s", [backend.name for backend in router.backends], routing)
+    metrics.gauge("active_connections", lambda: active_connections)
+    metrics.gauge("healthy_backends", lambda: sum(backend.healthy for backend in router.backends))
+    health_checks = asyncio.ensure_future(router.health_checks())
+
+    stop = asyncio.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal_number, stop.set)
+        except (NotImplementedError, RuntimeError): # windows, or not the main thread
+            pass
+
+    server = await asyncio.start_server(handle_player, "0.0.0.0", router_port)
+    logger.info("waiting for connections on port %d", router_port)
+    async with server:
+        await stop.wait()
+        server.close() # no new players, the connected ones get drain_timeout to finish
+        logger.info("draining %d connections", active_connections)
+        await drain(drain_timeout)
+    health_checks.cancel()
+
+def main():
+    logger.info("starting router")
+    metrics.serve(metrics_port)
+    asyncio.run(serve())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import numpy as np #pip install numpy
+
+import feedback
+
+# The answers still possible in a game are one python int used as a bitset, bit i stands for answers[i].
+# Feedback only ever says which letter is or isn't at a position and how many copies of a letter the answer has,
+# so narrowing is a handful of ANDs with masks precomputed for those two questions, never a scan of the list.
+
+
+class AnswerIndex:
+    """Bitmasks over one answer list, built once per word length"""
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.length = len(self.answers[0])
+        self.all = (1 << len(self.answers)) - 1
+        self.at_position = [{} for _ in range(self.length)] # position: {letter: answers with letter there}
+        self.at_least = {} # (letter, count): answers with at least count copies of letter
+        for i, answer in enumerate(self.answers):
+            bit = 1 << i
+            for position, letter in enumerate(answer):
+                self.at_position[position][letter] = self.at_position[position].get(letter, 0) | bit
+            for letter in set(answer):
+                for count in range(1, answer.count(letter) + 1):
+                    self.at_least[(letter, count)] = self.at_least.get((letter, count), 0) | bit
+        self.positions = {answer: i for i, answer in enumerate(self.answers)}
+
+    def position_mask(self, position, letter):
+        return self.at_position[position].get(letter, 0)
+
+    def count_mask(self, letter, count):
+        return self.at_least.get((letter, count), 0)
+
+
+class Candidates:
+    """Answers of an AnswerIndex still consistent with the feedback of one game"""
+    def __init__(self, index):
+        self.index = index
+        self.bits = index.all
+
+    def narrow(self, guess, pattern):
+        """keeps the answers that would have given this pattern for guess, a few microseconds"""
+        bits = self.bits
+        found = {} # letter: green and yellow copies in the guess, the answer has at least that many
+        capped = set() # letters with a gray copy, the answer has exactly as many as were found
+        for position, (letter, digit) in enumerate(zip(guess, feedback.decode(pattern, len(guess)))):
+            if digit == feedback.CORRECT_LETTER_POSITION:
+                bits &= self.index.position_mask(position, letter)
+            else:
+                bits &= ~self.index.position_mask(position, letter)
+            if digit == feedback.INCORRECT:
+                capped.add(letter)
+            else:
+                found[letter] = found.get(letter, 0) + 1
+        for letter, count in found.items():
+            bits &= self.index.count_mask(letter, count)
+        for letter in capped:
+            bits &= ~self.index.count_mask(letter, found.get(letter, 0) + 1)
+        self.bits = bits
+
+    def count(self) -> int:
+        return bin(self.bits).count("1")
+
+    def indexes(self) -> np.ndarray:
+        """:returns: the positions in the answer list of the remaining answers, sorted"""
+        size = (len(self.index.answers) + 7) // 8
+        bits = np.unpackbits(np.frombuffer(self.bits.to_bytes(size, "little"), dtype=np.uint8), bitorder="little")
+        return np.flatnonzero(bits[:len(self.index.answers)])
+
+    def words(self) -> list:
+        return [self.index.answers[i] for i in self.indexes()]
+
+
+def hard_mode_requirements(guesses, patterns):
+    """:returns: the letters the hints fix in place, {position: letter}, and the copies the answer is known to have, {letter: count}"""
+    greens = {}
+    required = {}
+    for earlier_guess, pattern in zip(guesses, patterns):
+        found = {}
+        for position, (letter, digit) in enumerate(zip(earlier_guess, feedback.decode(pattern, len(earlier_guess)))):
+            if digit == feedback.CORRECT_LETTER_POSITION:
+                greens[position] = letter
+            if digit != feedback.INCORRECT:
+                found[letter] = found.get(letter, 0) + 1
+        for letter, count in found.items():
+            required[letter] = max(required.get(letter, 0), count)
+    return greens, required
+
+def hard_mode_error(guesses, patterns, guess):
+    """:returns: why guess ignores a hint revealed by the earlier guesses, None if it uses all of them"""
+    greens, required = hard_mode_requirements(guesses, patterns)
+    for position, letter in sorted(greens.items()):
+        if guess[position] != letter:
+            return f"Letter {letter.upper()} must be in position {position + 1}"
+    for letter, count in sorted(required.items()):
+        if guess.count(letter) < count:
+            return f"Guess must contain {letter.upper()}" + (f" {count} times" if count > 1 else "")
+    return None
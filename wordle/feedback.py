@@ -0,0 +1,99 @@
+import hashlib
+import os
+
+import numpy as np #pip install numpy
+
+# A feedback pattern is stored as one base-3 integer: the digit at 3**i is the result for letter i of the guess.
+# For 5 letters that is 0..242, so a whole guess x answer table fits in one byte per cell.
+INCORRECT = 0 # gray
+CORRECT_LETTER = 1 # yellow
+CORRECT_LETTER_POSITION = 2 # green
+
+
+def score(answer, guess) -> int:
+    """:returns: feedback pattern of guess against answer, a repeated letter is only yellow as many times as the answer still has it"""
+    unmatched = {} # answer letters not already used by a green
+    for answer_letter, guess_letter in zip(answer, guess):
+        if answer_letter != guess_letter:
+            unmatched[answer_letter] = unmatched.get(answer_letter, 0) + 1
+
+    pattern = 0
+    weight = 1
+    for answer_letter, guess_letter in zip(answer, guess):
+        if answer_letter == guess_letter:
+            pattern += CORRECT_LETTER_POSITION * weight
+        elif unmatched.get(guess_letter, 0) > 0:
+            unmatched[guess_letter] -= 1
+            pattern += CORRECT_LETTER * weight
+        weight *= 3
+    return pattern
+
+def decode(pattern, length) -> list[int]:
+    """:returns: one INCORRECT/CORRECT_LETTER/CORRECT_LETTER_POSITION value per letter"""
+    digits = []
+    for _ in range(length):
+        pattern, digit = divmod(pattern, 3)
+        digits.append(digit)
+    return digits
+
+def encode(digits) -> int:
+    pattern = 0
+    for digit in reversed(digits):
+        pattern = pattern * 3 + digit
+    return pattern
+
+def winning_pattern(length) -> int:
+    return 3 ** length - 1
+
+
+def pattern_dtype(length):
+    return np.uint8 if 3 ** length <= 256 else np.uint16
+
+def encode_words(words) -> np.ndarray:
+    """:returns: (len(words), length) array of letter codes, all words must have the same length"""
+    return np.frombuffer("".join(words).encode(), dtype=np.uint8).reshape(len(words), -1)
+
+def score_batch(guess, answers: np.ndarray) -> np.ndarray:
+    """scores one guess against every row of answers (see encode_words) at once, same results as score()"""
+    letters = encode_words([guess])[0]
+    green = answers == letters
+    unmatched = ~green
+    patterns = np.zeros(len(answers), dtype=np.int32)
+    weight = 1
+    for i, letter in enumerate(letters):
+        available = ((answers == letter) & unmatched).sum(axis=1)
+        used = np.zeros(len(answers), dtype=np.int32) # earlier non-green copies of this letter in the guess
+        for j in range(i):
+            if letters[j] == letter:
+                used += unmatched[:, j]
+        yellow = unmatched[:, i] & (used < available)
+        patterns += np.where(green[:, i], CORRECT_LETTER_POSITION, np.where(yellow, CORRECT_LETTER, INCORRECT)) * weight
+        weight *= 3
+    return patterns
+
+
+def build_pattern_matrix(guesses, answers) -> np.ndarray:
+    """:returns: (len(guesses), len(answers)) array with the pattern of every guess against every answer"""
+    encoded_answers = encode_words(answers)
+    matrix = np.empty((len(guesses), len(answers)), dtype=pattern_dtype(len(answers[0])))
+    for row, guess in enumerate(guesses):
+        matrix[row] = score_batch(guess, encoded_answers)
+    return matrix
+
+def pattern_matrix_path(directory, guesses, answers):
+    """the file name includes a digest of both word lists, so a changed list never reads a stale table"""
+    digest = hashlib.sha1("\n".join(guesses).encode() + b"\0" + "\n".join(answers).encode()).hexdigest()[:16]
+    return os.path.join(directory, f"patterns_{len(answers[0])}_{digest}.npy")
+
+def load_pattern_matrix(directory, guesses, answers) -> np.ndarray:
+    """memory-maps the precomputed table for these word lists, building and saving it first if needed"""
+    path = pattern_matrix_path(directory, guesses, answers)
+    if os.path.exists(path):
+        return np.load(path, mmap_mode="r")
+    matrix = build_pattern_matrix(guesses, answers)
+    os.makedirs(directory, exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as file:
+        np.save(file, matrix)
+    os.replace(temporary_path, path) # other workers never see a half written file
+    return np.load(path, mmap_mode="r")
@@ -0,0 +1,142 @@
+"""Entropy based Wordle solver, used by the game server for hints.
+
+Every guess splits the remaining candidate answers into groups by the feedback pattern it would get,
+the best guess is the one whose groups are the most even, the one that tells the most bits on average.
+The patterns of every guess against every answer are precomputed once, see feedback.load_pattern_matrix.
+
+batch mode, solves every answer of one length and reports the average guess count:
+       python solver.py --length 5 --processes 4
+"""
+import argparse
+import multiprocessing
+import os
+import time
+
+import numpy as np #pip install numpy
+
+import feedback
+
+pattern_cache_directory = os.environ.get("PATTERN_CACHE", "pattern_cache")
+
+
+class Solver:
+    def __init__(self, guesses, answers, directory=pattern_cache_directory):
+        self.guesses = list(guesses)
+        self.answers = list(answers)
+        self.length = len(self.answers[0])
+        self.pattern_count = 3 ** self.length
+        self.guess_rows = {guess: row for row, guess in enumerate(self.guesses)}
+        self.answer_rows = np.array([self.guess_rows.get(answer, -1) for answer in self.answers]) # guess row of every answer
+        self.encoded_answers = feedback.encode_words(self.answers)
+        self.encoded_guesses = feedback.encode_words(self.guesses)
+        self.matrix = feedback.load_pattern_matrix(directory, self.guesses, self.answers)
+        self.row_offsets = np.arange(len(self.guesses), dtype=np.int64)[:, None] * self.pattern_count
+        self.opening = None
+        self.opening = self.best_guess(self.all_candidates()) # the same for every game, so it is only worked out once
+
+    def all_candidates(self) -> np.ndarray:
+        """:returns: indexes into answers of every answer, before the first guess"""
+        return np.arange(len(self.answers))
+
+    def narrow(self, candidates, guess, pattern) -> np.ndarray:
+        """:returns: the candidates that give this pattern for guess"""
+        row = self.guess_rows.get(guess)
+        if row is not None:
+            patterns = self.matrix[row, candidates]
+        else: # a word the dictionary accepts but the guess list doesn't have
+            patterns = feedback.score_batch(guess, self.encoded_answers[candidates])
+        return candidates[patterns == pattern]
+
+    def entropies(self, candidates, rows=None) -> np.ndarray:
+        """:returns: expected information in bits of every guess, or of the guesses in rows, over the candidates"""
+        if rows is None:
+            patterns = self.matrix[:, candidates] + self.row_offsets # one bincount for every row at once
+        else:
+            patterns = self.matrix[rows][:, candidates] + self.row_offsets[:len(rows)]
+        counts = np.bincount(patterns.ravel(), minlength=patterns.shape[0] * self.pattern_count)
+        counts = counts.reshape(patterns.shape[0], self.pattern_count)
+        total = len(candidates)
+        weighted = np.where(counts > 0, counts * np.log2(np.maximum(counts, 1)), 0.0).sum(axis=1)
+        return np.log2(total) - weighted / total
+
+    def hard_mode_rows(self, greens, required) -> np.ndarray:
+        """:returns: rows of the guesses that keep every letter in greens, {position: letter},
+        and have at least the copies in required, {letter: count}, see candidates.hard_mode_requirements"""
+        allowed = np.ones(len(self.guesses), dtype=bool)
+        for position, letter in greens.items():
+            allowed &= self.encoded_guesses[:, position] == ord(letter)
+        for letter, count in required.items():
+            allowed &= (self.encoded_guesses == ord(letter)).sum(axis=1) >= count
+        return np.flatnonzero(allowed)
+
+    def best_guess(self, candidates, rows=None):
+        """:returns: the guess with the highest entropy over the candidates, one of them if it is a tie, None if there are none,
+        only the guesses in rows are considered if given, the candidates must be among them"""
+        if len(candidates) == 0:
+            return None
+        if len(candidates) <= 2: # a candidate can win right away, any other guess can't
+            return self.answers[candidates[0]]
+        if len(candidates) == len(self.answers) and self.opening is not None and rows is None:
+            return self.opening
+        scores = self.entropies(candidates, rows)
+        if rows is None:
+            rows = np.arange(len(self.guesses))
+        scores[np.isin(rows, self.answer_rows[candidates])] += 1e-9 # breaks ties in favour of a guess that could be the answer
+        return self.guesses[int(rows[np.argmax(scores)])]
+
+    def solve(self, answer, max_guesses=20) -> list:
+        """:returns: the guesses the solver makes until it finds answer"""
+        candidates = self.all_candidates()
+        guesses = []
+        while len(guesses) < max_guesses:
+            guess = self.best_guess(candidates)
+            if guess is None:
+                break
+            guesses.append(guess)
+            pattern = feedback.score(answer, guess)
+            if pattern == feedback.winning_pattern(self.length):
+                break
+            candidates = self.narrow(candidates, guess, pattern)
+        return guesses
+
+
+worker_solver = None
+
+def start_worker(words, directory):
+    global worker_solver
+    worker_solver = Solver(words, words, directory) # memory-maps the table the parent already saved
+
+def count_guesses(answer):
+    return len(worker_solver.solve(answer))
+
+def benchmark(words, processes=None, directory=pattern_cache_directory):
+    """solves every word of the list, spread over processes, :returns: guess count of every word"""
+    Solver(words, words, directory) # builds and saves the table once, before the workers load it
+    with multiprocessing.Pool(processes, initializer=start_worker, initargs=(words, directory)) as pool:
+        return pool.map(count_guesses, words, chunksize=max(1, len(words) // (4 * (processes or os.cpu_count() or 1))))
+
+
+def load_words(path, length):
+    with open(path) as file:
+        return sorted({word for word in (line.strip().lower() for line in file) if len(word) == length and word.isalpha()})
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--words", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dictionary", "words.txt"))
+    parser.add_argument("--length", type=int, default=5)
+    parser.add_argument("--processes", type=int, default=None, help="defaults to one per core")
+    parser.add_argument("--guesses-limit", type=int, default=6, help="games that take more guesses count as lost")
+    args = parser.parse_args()
+
+    words = load_words(args.words, args.length)
+    start = time.perf_counter()
+    counts = benchmark(words, args.processes)
+    elapsed = time.perf_counter() - start
+    print(f"solved {len(words)} words of length {args.length} in {elapsed:.2f}s")
+    print(f"average guesses: {sum(counts) / len(counts):.3f}, worst: {max(counts)}")
+    print(f"lost with a limit of {args.guesses_limit}: {sum(count > args.guesses_limit for count in counts)}")
+    for guesses_count in range(1, max(counts) + 1):
+        print(f"  {guesses_count}: {counts.count(guesses_count)}")
+
+if __name__ == '__main__':
+    main()
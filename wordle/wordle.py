@@ -1,9 +1,27 @@
+import asyncio
+import datetime
 import json
+import logging
+import os
+import signal
 import socket
-import threading
 import time
+import uuid
+from contextlib import nullcontext
 from enum import Enum
 
+import feedback
+import metrics
+import protocol
+import tokens
+from candidates import AnswerIndex, Candidates, hard_mode_error, hard_mode_requirements
+from solver import Solver
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s %(message)s")
+logger = logging.getLogger("wordle")
+metrics.namespace = "wordle"
+metrics_port = int(os.environ.get("METRICS_PORT", "9101"))
+
 endpoints = {
   "dictionary": {
     "ip": 'dictionary_container',
@@ -20,8 +38,20 @@ endpoints = {
   "wordle": {
     "ip": 'wordle_container',
     "port": 12347
+  },
+  "router": {
+    "ip": 'wordle_router',
+    "port": 12347
   }
 }
+# a json file of the same shape in ENDPOINTS_FILE, then <NAME>_IP and <NAME>_PORT variables, override the defaults above
+if os.environ.get("ENDPOINTS_FILE"):
+    with open(os.environ["ENDPOINTS_FILE"]) as endpoints_file:
+        for name, endpoint in json.load(endpoints_file).items():
+            endpoints.setdefault(name, {}).update(endpoint)
+for name, endpoint in endpoints.items():
+    endpoint["ip"] = os.environ.get(f"{name.upper()}_IP", endpoint["ip"])
+    endpoint["port"] = int(os.environ.get(f"{name.upper()}_PORT", endpoint["port"]))
 
 wordle_endpoints = endpoints["wordle"]
 wordle_ip = wordle_endpoints["ip"]
@@ -36,15 +66,209 @@ dictionary_endpoints = endpoints["dictionary"]
 dictionary_server_ip = dictionary_endpoints["ip"]
 dictionary_server_port = dictionary_endpoints["port"]
 
-def database_query(json_data):
-    #print("sending request: ", json_data["packet_type"])
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client.connect((mongo_api_ip, mongo_api_port))
-    client.settimeout(5.0)
-    client.send(json_data.encode())
-    response_json = client.recv(4096).decode()
-    print("response: ", response_json)
-    return response_json
+max_packet_size = 16 * 1024 * 1024
+
+# behind the router every login comes from its address, with the player's in "forwarded_for"
+trust_forwarded_for = os.environ.get("TRUST_FORWARDED_FOR") == "1"
+drain_timeout = float(os.environ.get("DRAIN_TIMEOUT", "30")) # seconds connected players get to finish on shutdown
+active_players = 0
+
+async def write_frame(writer, data):
+    """sends one encoded packet prefixed with its 4-byte length, so the receiver knows where it ends"""
+    writer.write(len(data).to_bytes(4, "big") + data)
+    await writer.drain()
+
+async def write_packet(writer, packet):
+    """sends one json packet"""
+    await write_frame(writer, packet.encode())
+
+async def read_frame(reader):
+    """:returns: the next encoded packet, or empty bytes if the peer closed the connection"""
+    try:
+        header = await reader.readexactly(4)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return b""
+        raise ConnectionResetError("connection closed mid-packet")
+    size = int.from_bytes(header, "big")
+    if size > max_packet_size:
+        raise ValueError(f"packet of {size} bytes is too large")
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        raise ConnectionResetError("connection closed mid-packet")
+
+async def read_packet(reader):
+    """:returns: the next json packet, or an empty string if the peer closed the connection"""
+    return (await read_frame(reader)).decode()
+
+
+backend_pool_size = int(os.environ.get("BACKEND_POOL_SIZE", "16"))
+# logins, registrations and password changes wait for bcrypt, they get their own connections and slots to the mongo api,
+# so a burst of them can't hold up the games
+auth_pool_size = int(os.environ.get("AUTH_POOL_SIZE", "8"))
+backend_timeout = 5.0
+# encodings offered to the mongo api and the dictionary, preferred first, BACKEND_ENCODINGS=json keeps internal traffic on json
+backend_encodings = [encoding for encoding in os.environ.get("BACKEND_ENCODINGS", ",".join(protocol.supported_encodings)).split(",")
+                     if encoding in protocol.supported_encodings] or ["json"]
+backend_multiplex = os.environ.get("BACKEND_MULTIPLEX", "1") == "1"
+backend_shared_connections = int(os.environ.get("BACKEND_SHARED_CONNECTIONS", "2")) # per backend, when it multiplexes
+
+
+class BackendConnection:
+    """One connection to a backend service, in the encoding its hello agreed on.
+    A multiplexed one carries many requests at once, every response goes to the request with its id"""
+    def __init__(self, reader, writer, encoding="json", multiplex=False):
+        self.reader = reader
+        self.writer = writer
+        self.encoding = encoding
+        self.multiplex = multiplex
+        self.closed = False
+        if multiplex:
+            self.waiting = {} # request id: future of its response
+            self.next_request_id = 0
+            self.write_lock = asyncio.Lock() # python 3.9 streams can't drain for two writers at once
+            self.receiver = asyncio.ensure_future(self.receive())
+
+    async def exchange(self, packet, timeout):
+        """sends one request and waits for its response, nothing else may use the connection meanwhile"""
+        await write_frame(self.writer, protocol.encode(packet, self.encoding))
+        data = await asyncio.wait_for(read_frame(self.reader), timeout)
+        if not data:
+            raise ConnectionResetError("backend closed the connection")
+        return protocol.decode(data, self.encoding)
+
+    async def request(self, packet, timeout):
+        if not self.multiplex:
+            return await self.exchange(packet, timeout)
+        if self.closed:
+            raise ConnectionResetError("backend closed the connection")
+        request_id = self.next_request_id
+        self.next_request_id = (request_id + 1) % 2**32
+        response = asyncio.get_running_loop().create_future()
+        self.waiting[request_id] = response
+        try:
+            async with self.write_lock:
+                await write_frame(self.writer, request_id.to_bytes(4, "big") + protocol.encode(packet, self.encoding))
+            data = await asyncio.wait_for(response, timeout)
+        finally:
+            self.waiting.pop(request_id, None)
+        return protocol.decode(data, self.encoding)
+
+    async def receive(self):
+        """hands every response of a multiplexed connection to its request, a late one to a request that timed out is dropped"""
+        error = ConnectionResetError("backend closed the connection")
+        try:
+            while True:
+                data = await read_frame(self.reader)
+                if not data:
+                    break
+                response = self.waiting.pop(int.from_bytes(data[:4], "big"), None)
+                if response is not None and not response.done():
+                    response.set_result(data[4:])
+        except (ConnectionError, OSError, ValueError) as e:
+            error = ConnectionResetError(f"backend connection lost: {e!r}")
+        self.close(error)
+
+    def close(self, error=None):
+        self.closed = True
+        self.writer.close()
+        if self.multiplex:
+            for response in self.waiting.values():
+                if not response.done():
+                    response.set_exception(error or ConnectionResetError("backend connection closed"))
+            self.waiting.clear()
+
+
+class ConnectionPool:
+    """Persistent connections to one backend service, shared by every player on the event loop.
+    Every new connection offers the backend our encodings and multiplexing in a hello. A backend that multiplexes
+    gets every request on a few shared connections, many at once on each, otherwise a connection carries one request at a time"""
+    def __init__(self, ip, port, max_size=backend_pool_size, timeout=backend_timeout, encodings=None, multiplex=None, shared_size=None):
+        self.address = (ip, port)
+        self.timeout = timeout
+        self.encodings = encodings or backend_encodings
+        self.offer_multiplex = backend_multiplex if multiplex is None else multiplex
+        self.shared_size = shared_size or backend_shared_connections
+        self.multiplexed = None # known after the first hello
+        self.idle = [] # connections without multiplexing, most recently used last, so the rest can be dropped by the server when idle
+        self.shared = [] # multiplexed connections, used in turn
+        self.next_shared = 0
+        self.slots = asyncio.Semaphore(max_size) # bounds the requests in flight, must be created inside the running loop
+        self.connecting = asyncio.Lock()
+
+    async def connect(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*self.address), self.timeout)
+        connection = BackendConnection(reader, writer)
+        if self.encodings == ["json"] and not self.offer_multiplex:
+            return connection
+        try:
+            answer = await connection.exchange(protocol.hello(self.encodings, self.offer_multiplex), self.timeout)
+        except BaseException:
+            connection.close()
+            raise
+        if answer.get("packet_type") != "hello": # an older backend answers the hello with an error and stays on json
+            return connection
+        logger.info("%s:%d speaks %s%s", *self.address, answer["encoding"], ", multiplexed" if answer["multiplex"] else "")
+        return BackendConnection(reader, writer, answer["encoding"], answer["multiplex"])
+
+    async def acquire(self):
+        """:returns: a connection for one request, and whether it carried requests before"""
+        if self.multiplexed is not False:
+            async with self.connecting: # the first connection tells whether the backend multiplexes, the other requests wait for it
+                self.shared = [connection for connection in self.shared if not connection.closed]
+                if self.multiplexed is None or len(self.shared) < self.shared_size:
+                    connection = await self.connect()
+                    self.multiplexed = connection.multiplex
+                    if connection.multiplex:
+                        self.shared.append(connection)
+                    return connection, False
+                self.next_shared = (self.next_shared + 1) % len(self.shared)
+                return self.shared[self.next_shared], True
+        if self.idle:
+            return self.idle.pop(), True
+        return await self.connect(), False
+
+    async def request(self, packet):
+        """sends one request and :returns: its response, reconnecting once if a pooled connection went stale"""
+        async with self.slots:
+            connection, reused = await self.acquire()
+            try:
+                try:
+                    response = await connection.request(packet, self.timeout)
+                except ConnectionError:
+                    connection.close()
+                    if not reused:
+                        raise
+                    connection, _ = await self.acquire() # the server dropped the connection while it was idle
+                    response = await connection.request(packet, self.timeout)
+            except BaseException:
+                if not connection.multiplex:
+                    connection.close() # its response may still come, no other request can use it
+                raise
+            if not connection.multiplex:
+                self.idle.append(connection)
+            return response
+
+
+mongo_api_pool = None
+mongo_auth_pool = None
+dictionary_pool = None
+
+
+async def database_query(request):
+    """:returns: the mongo api's response to request"""
+    with metrics.timed("backend_call_seconds", call="database_query"):
+        response = await mongo_api_pool.request(request)
+    logger.debug("response: %s", response)
+    return response
+
+async def auth_query(request):
+    """:returns: the mongo api's response to a login, register or change_password request"""
+    with metrics.timed("backend_call_seconds", call="auth_query"):
+        response = await mongo_auth_pool.request(request)
+    logger.debug("response: %s", response)
+    return response
 
 
 class GuessInfo(str, Enum):
@@ -52,214 +276,648 @@ class GuessInfo(str, Enum):
     CORRECT_LETTER = "CORRECT_LETTER" # yellow
     CORRECT_LETTER_POSITION = "CORRECT_LETTER_POSITION" #green
 
-def compare(word, guess) -> list[GuessInfo]:
-    info = list(GuessInfo.INCORRECT for _ in range(len(word)))
-
-    print("CHECKING: ", word, guess)
-
+guess_info_by_digit = [GuessInfo.INCORRECT, GuessInfo.CORRECT_LETTER, GuessInfo.CORRECT_LETTER_POSITION] # indexed by feedback digit
 
-    #check for correct letter in correct position
-    for i in range(len(word)):
-        if word[i] == guess[i]:
-            info[i] = GuessInfo.CORRECT_LETTER_POSITION
+def describe(pattern, length) -> list[GuessInfo]:
+    return [guess_info_by_digit[digit] for digit in feedback.decode(pattern, length)]
 
-    #check for correct letter in wrong position
-    for i in range(len(word)):
-        if word[i] != guess[i] and guess[i] in word:
-            info[i] = GuessInfo.CORRECT_LETTER
+def compare(word, guess) -> list[GuessInfo]:
+    return describe(feedback.score(word, guess), len(word))
 
-    return info
 
+def dictionary_answer(response):
+    """:returns: the answer in a dictionary response, raises RuntimeError with its message if the dictionary answered with an error"""
+    if response.get("packet_type") == "error":
+        raise RuntimeError(f"dictionary error: {response.get('response')}")
+    return response["response"]
 
-def is_word_valid(word):
+async def is_word_valid(word):
     #return True
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client.connect((dictionary_server_ip, dictionary_server_port))
-    client.settimeout(5.0)
-    request_json = json.dumps({"packet_type": "validate_word", "word": word})
-    client.send(request_json.encode())
-    response_json = client.recv(4096).decode()
-    result: bool = json.loads(response_json)["response"]
-    message = "valid" if result else "invalid"
-    print(f"word \"{word}\" is {message}")
+    with metrics.timed("backend_call_seconds", call="is_word_valid"):
+        response = await dictionary_pool.request({"packet_type": "validate_word", "word": word})
+    result: bool = dictionary_answer(response)
+    logger.debug("word %r valid: %s", word, result)
     return result
-def get_random_word(length=5):
+async def get_random_word(length=5):
     #return "hello"
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client.connect((dictionary_server_ip, dictionary_server_port))
-    client.settimeout(5.0)
-    request_json = json.dumps({"packet_type": "get_random_word", "length": length})
-    client.send(request_json.encode())
-    response_json = client.recv(4096).decode()
-    print(json.loads(response_json))
-    random_word = json.loads(response_json)["response"]
+    with metrics.timed("backend_call_seconds", call="get_random_word"):
+        response = await dictionary_pool.request({"packet_type": "get_random_word", "length": length})
+    random_word = dictionary_answer(response)
     return random_word
+async def get_daily_word(date, length=5):
+    with metrics.timed("backend_call_seconds", call="get_daily_word"):
+        response = await dictionary_pool.request({"packet_type": "get_daily_word", "date": date, "length": length})
+    return dictionary_answer(response)
+async def get_word_list(length=5):
+    with metrics.timed("backend_call_seconds", call="get_word_list"):
+        response = await dictionary_pool.request({"packet_type": "get_word_list", "length": length})
+    return dictionary_answer(response)
+
+
+solver_preload_lengths = [int(length) for length in os.environ.get("SOLVER_PRELOAD_LENGTHS", "5").split(",") if length]
+answer_indexes = {} # length: future of the AnswerIndex over its word list, shared by every game
+solvers = {} # length: future of its Solver, built over the same word list, so candidate bits are solver answer indexes
+
+async def load_once(table, length, load):
+    """:returns: load(length), started only once per length, a failed load is retried by the next caller"""
+    future = table.get(length)
+    if future is None:
+        future = table[length] = asyncio.ensure_future(load(length))
+    try:
+        return await asyncio.shield(future)
+    except Exception:
+        if table.get(length) is future:
+            del table[length]
+        raise
+
+async def load_answer_index(length):
+    words = await get_word_list(length)
+    if not words:
+        raise ValueError(f"No words of length {length}")
+    return await asyncio.get_running_loop().run_in_executor(None, AnswerIndex, words)
+
+async def load_solver(length):
+    index = await get_answer_index(length)
+    start = time.perf_counter()
+    solver = await asyncio.get_running_loop().run_in_executor(None, Solver, index.answers, index.answers) # builds the table the first time
+    logger.info("solver for %d letter words ready in %.2fs, opening: %s", length, time.perf_counter() - start, solver.opening)
+    return solver
+
+async def get_answer_index(length):
+    return await load_once(answer_indexes, length, load_answer_index)
+
+async def find_answer_index(length):
+    """:returns: the AnswerIndex for this length, None if the dictionary can't give one, the game works without it"""
+    try:
+        return await get_answer_index(length)
+    except (OSError, asyncio.TimeoutError, RuntimeError, ValueError, KeyError) as e:
+        logger.warning("no answer index for %d letter words: %r", length, e)
+        return None
 
+async def get_solver(length):
+    return await load_once(solvers, length, load_solver)
+
+async def preload_solvers():
+    for length in solver_preload_lengths:
+        try:
+            await get_solver(length)
+        except Exception as e:
+            logger.warning("could not preload the %d letter solver: %r", length, e)
 
 
 class Wordle:
-    def __init__(self, word_length=5, guesses_number=6):
-        self.word = get_random_word(word_length)
+    def __init__(self, word, word_length=5, guesses_number=6, answer_index=None, hard_mode=False, game_id=None, daily=None, started_at=None):
+        self.id = game_id or str(uuid.uuid4())
+        self.word = word
+        self.daily = daily # date of the daily challenge this game is, None for a random word
+        self.started_at = started_at or time.time() # wall clock, the game may be resumed on another server
         self.guesses = []
+        self.patterns = [] # feedback pattern of every guess
         self.word_length = word_length
         self.guesses_number = guesses_number
-        print("Wordle word: ", self.word)
-
-    def guess(self, guess):
-        """:returns: list of GuessInfo enums"""
+        self.hard_mode = hard_mode # every guess must use the hints revealed so far
+        # answers still consistent with the feedback, None without a local list that has the word
+        self.candidates = Candidates(answer_index) if answer_index is not None and word in answer_index.positions else None
+        self.remaining = [] # candidates left after every guess, kept with the game for analytics
+        logger.debug("new game, word: %s", self.word)
+
+    @classmethod
+    async def new_game(cls, word_length=5, guesses_number=6, hard_mode=False, daily=None):
+        word = await get_daily_word(daily, word_length) if daily else await get_random_word(word_length)
+        answer_index = await find_answer_index(word_length)
+        return cls(word, word_length=word_length, guesses_number=guesses_number, answer_index=answer_index, hard_mode=hard_mode, daily=daily)
+
+    @classmethod
+    async def from_checkpoint(cls, game):
+        """rebuilds a game saved by checkpoint(), on this or any other game server"""
+        answer_index = await find_answer_index(game["word_length"])
+        wordle = cls(game["word"], word_length=game["word_length"], guesses_number=game["guesses_number"],
+                     answer_index=answer_index, hard_mode=game["hard_mode"], game_id=game["id"],
+                     daily=game.get("daily"), started_at=game.get("started_at"))
+        for guess in game["guesses"]:
+            wordle.record_guess(guess)
+        return wordle
+
+    def checkpoint(self):
+        """:returns: everything needed to resume the game, the rest is worked out again from the guesses"""
+        return {"id": self.id, "word": self.word, "guesses": self.guesses, "word_length": self.word_length,
+                "guesses_number": self.guesses_number, "hard_mode": self.hard_mode, "daily": self.daily, "started_at": self.started_at}
+
+    async def guess(self, guess):
+        """:returns: list of GuessInfo enums, or why the guess was rejected in hard mode"""
+        guess = guess.lower() # the dictionary validates lowercase, so scoring and hard mode must see the same word
         if len(guess) != self.word_length:
             return 0 # "Invalid guess, may try again"
-        if is_word_valid(guess) == False:
+        if self.hard_mode:
+            error = hard_mode_error(self.guesses, self.patterns, guess)
+            if error is not None:
+                return error
+        if await is_word_valid(guess) == False:
             return 1
+        return describe(self.record_guess(guess), self.word_length)
+
+    def record_guess(self, guess):
+        """:returns: the feedback pattern of a valid guess"""
+        pattern = feedback.score(self.word, guess)
         self.guesses.append(guess)
-        return compare(self.word, guess)
+        self.patterns.append(pattern)
+        if self.candidates is not None:
+            self.candidates.narrow(guess, pattern)
+            self.remaining.append(self.candidates.count())
+        return pattern
+
+    def remaining_count(self):
+        """:returns: how many answers are still possible, None if the game can't tell"""
+        return self.candidates.count() if self.candidates is not None else None
+
+    def hint(self, solver):
+        """:returns: the most informative next guess and how many answers are still possible, in hard mode one it accepts"""
+        if self.candidates is None:
+            return None, 0
+        rows = solver.hard_mode_rows(*hard_mode_requirements(self.guesses, self.patterns)) if self.hard_mode else None
+        return solver.best_guess(self.candidates.indexes(), rows), self.candidates.count()
 
 
 def is_winner(result):
     return all([x == GuessInfo.CORRECT_LETTER_POSITION for x in result])
 
 
-def upload_history(data, token):
-    return database_query(json.dumps({"packet_type": "add_history", "data": data, "token": token}))
+history_batch_size = int(os.environ.get("HISTORY_BATCH_SIZE", "100"))
+history_flush_interval = float(os.environ.get("HISTORY_FLUSH_INTERVAL", "1.0")) # seconds
+history_max_attempts = int(os.environ.get("HISTORY_MAX_ATTEMPTS", "8"))
+
+
+class HistoryWriter:
+    """Write-behind queue of finished games, sent to the mongo api in add_history_bulk batches
+    once history_batch_size games are waiting or the oldest one waited history_flush_interval"""
+    def __init__(self, batch_size=history_batch_size, flush_interval=history_flush_interval, max_attempts=history_max_attempts):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.queue = asyncio.Queue(maxsize=batch_size * 100)
+        self.pending = {} # token: future of that player's latest queued game
+        self.readers_waiting = 0
+        self.flush_now = None # set while a player waits for their games, so the batch is sent without waiting out the interval
+        self.task = None
+
+    def start(self):
+        self.flush_now = asyncio.Event() # must be created inside the running loop
+        self.task = asyncio.ensure_future(self.run())
+
+    async def add(self, token, data):
+        game = {"id": str(uuid.uuid4()), "token": token, "timestamp": time.time(), "data": data}
+        future = asyncio.get_running_loop().create_future()
+        self.pending[token] = future
+        await self.queue.put((game, future))
+
+    async def wait_for(self, token):
+        """waits until the player's queued games are stored, so their next read or logout sees them"""
+        future = self.pending.get(token)
+        if future is not None:
+            self.readers_waiting += 1
+            self.flush_now.set()
+            try:
+                await asyncio.wait([future], timeout=self.flush_interval * 10)
+            finally:
+                self.readers_waiting -= 1
+
+    async def close(self):
+        """flushes everything still queued and stops"""
+        await self.queue.put(None)
+        await self.task
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            if not self.readers_waiting:
+                self.flush_now.clear()
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            stopping = False
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0 or (self.flush_now.is_set() and self.queue.empty()):
+                    break
+                try:
+                    item = await self.next_item(timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self.flush(batch)
+            if stopping:
+                return
+
+    async def next_item(self, timeout):
+        """:returns: the next queued game, raises asyncio.TimeoutError after timeout seconds or as soon as a player waits"""
+        get = asyncio.ensure_future(self.queue.get())
+        wake = asyncio.ensure_future(self.flush_now.wait())
+        try:
+            done, _ = await asyncio.wait([get, wake], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            wake.cancel()
+            if not get.done():
+                get.cancel() # a cancelled get leaves its item in the queue
+        if get in done:
+            return get.result()
+        raise asyncio.TimeoutError
+
+    async def flush(self, batch):
+        request = {"packet_type": "add_history_bulk", "games": [game for game, _ in batch]}
+        delay = 0.5
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                response = await database_query(request)
+                if response["packet_type"] == "error":
+                    raise RuntimeError(response["response"])
+                metrics.inc("history_games_written_total", amount=response["inserted"])
+                metrics.inc("history_games_rejected_total", amount=response["rejected"])
+                break
+            except (OSError, asyncio.TimeoutError, RuntimeError, ValueError, KeyError) as e:
+                logger.warning("history batch of %d games failed, attempt %d: %r", len(batch), attempt, e)
+                if attempt < self.max_attempts:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 30.0)
+        else:
+            metrics.inc("history_games_dropped_total", amount=len(batch))
+            logger.error("dropped a history batch of %d games", len(batch))
+        for game, future in batch:
+            future.set_result(None)
+            if self.pending.get(game["token"]) is future:
+                del self.pending[game["token"]]
+
+
+history_writer = None
 
 
 
-def play_wordle(client, token):
+min_word_length = 4
+max_word_length = 8
+max_guesses_number = 12
+daily_word_length = 5 # the same for everyone, so the leaderboard compares like with like
+daily_guesses_number = 6
+
+def today():
+    """:returns: the date of the daily challenge, in UTC so every server agrees on it"""
+    return datetime.datetime.utcnow().date().isoformat()
+
+def whole_number(value):
+    """:returns: value as an int, None if the player sent something that isn't a number"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+async def play_wordle(reader, writer, token, hard_mode=False, daily=False, word_length=5, guesses_number=6, pattern_feedback=False):
     #packet_json = json.dumps({"packet_type":"message","message": "guess the word!"})
-    #client.send(packet_json.encode())
-    word_length = 5
-    guesses_number = 6
-    wordle = Wordle(word_length=word_length, guesses_number=guesses_number)
+    #await write_packet(writer, packet_json)
+    if daily:
+        word_length, guesses_number = daily_word_length, daily_guesses_number
+    else:
+        word_length, guesses_number = whole_number(word_length), whole_number(guesses_number)
+    if word_length is None or guesses_number is None or not (min_word_length <= word_length <= max_word_length and 1 <= guesses_number <= max_guesses_number):
+        response_json = json.dumps({"packet_type": "error", "response": f"Words are {min_word_length} to {max_word_length} letters long, "
+                                                                       f"with 1 to {max_guesses_number} guesses"})
+        await write_packet(writer, response_json)
+        return
+    date = today() if daily else None
+    resumed = None
+    with metrics.timed("packet_seconds", packet_type="play"):
+        if daily:
+            # today's checkpoint is kept apart from the random game's, and refused once today's result is in
+            saved = await database_query({"packet_type": "load_game", "token": token, "daily": date})
+            if saved.get("played"):
+                await write_packet(writer, json.dumps({"packet_type": "error", "response": "You already played today's word"}))
+                return
+            if saved["packet_type"] != "error":
+                # starting over would forget the guesses already spent on today's word
+                resumed = await Wordle.from_checkpoint(saved["game"])
+        if resumed is None:
+            wordle = await Wordle.new_game(word_length=word_length, guesses_number=guesses_number, hard_mode=hard_mode, daily=date)
+            await save_game(token, wordle)
+    if resumed is not None:
+        await continue_game(reader, writer, token, resumed, pattern_feedback)
+    else:
+        await play_game(reader, writer, token, wordle, pattern_feedback)
+
+async def resume_wordle(reader, writer, token, pattern_feedback=False):
+    """continues the player's checkpointed game, which may have been started on another game server"""
+    with metrics.timed("packet_seconds", packet_type="resume"):
+        response = await database_query({"packet_type": "load_game", "token": token})
+        if response["packet_type"] == "error":
+            await write_packet(writer, json.dumps(response))
+            return
+        wordle = await Wordle.from_checkpoint(response["game"])
+    await continue_game(reader, writer, token, wordle, pattern_feedback)
+
+async def continue_game(reader, writer, token, wordle, pattern_feedback=False):
+    results = list(wordle.patterns) if pattern_feedback else [describe(pattern, wordle.word_length) for pattern in wordle.patterns]
+    await write_packet(writer, json.dumps({"packet_type": "resumed", "guesses": wordle.guesses, "results": results,
+                                           "word_length": wordle.word_length, "guesses_number": wordle.guesses_number,
+                                           "hard_mode": wordle.hard_mode, "daily": wordle.daily, "remaining": wordle.remaining_count()}))
+    await play_game(reader, writer, token, wordle, pattern_feedback)
+
+async def save_game(token, wordle):
+    """checkpoints the game in the mongo api, a failed checkpoint only costs the chance to resume"""
+    try:
+        response = await database_query({"packet_type": "save_game", "token": token, "game": wordle.checkpoint()})
+        if response["packet_type"] == "error":
+            logger.warning("could not checkpoint game: %s", response["response"])
+    except (OSError, asyncio.TimeoutError, ValueError) as e:
+        logger.warning("could not checkpoint game: %r", e)
+
+async def delete_game(token, wordle):
+    try:
+        await database_query({"packet_type": "delete_game", "token": token, "game_id": wordle.id, "daily": wordle.daily})
+    except (OSError, asyncio.TimeoutError) as e:
+        logger.warning("could not delete checkpoint of a finished game: %r", e)
+
+async def play_game(reader, writer, token, wordle, pattern_feedback=False):
+    """pattern_feedback sends every result as its base-3 pattern, feedback.decode gives the digit of each letter back"""
+    word_length = wordle.word_length
+    guesses_number = wordle.guesses_number
     while True:
         packet_json = json.dumps({"packet_type": "waiting_for_guess", "guess_number": len(wordle.guesses)+1 })
-        client.send(packet_json.encode())
-        request_json = client.recv(4096).decode()
+        await write_packet(writer, packet_json)
+        request_json = await read_packet(reader)
+        if not request_json:
+            raise ConnectionResetError("player left during a game, it stays checkpointed")
         packet_type = json.loads(request_json)["packet_type"]
 
+        metrics.inc("packets_total", packet_type=packet_label(packet_type))
         if packet_type == "logout":
-            print("Player quit")
+            logger.debug("player quit during a game")
             break
+        if packet_type == "hint":
+            with metrics.timed("packet_seconds", packet_type="hint"):
+                await send_hint(writer, wordle)
+            continue
         if packet_type == "guess":
             guess = json.loads(request_json)["guess"]
-            print("Guess: ", guess)
+            logger.debug("guess: %s", guess)
+            guess_start = time.perf_counter()
 
             if len(guess) != word_length:
                 response_json = json.dumps({"packet_type":"error", "response": f"Invalid guess, guess must be {word_length} characters long, try again"})
-                client.send(response_json.encode())
-                print("ack: ", client.recv(4096).decode())
+                await write_packet(writer, response_json)
                 continue
 
 
-            result = wordle.guess(guess)
-            print("Result: ", result)
+            result = await wordle.guess(guess)
+            logger.debug("result: %s", result)
 
             if result == 0:
                 response_json = json.dumps({"packet_type": "error", "response": f"Word must be {word_length} characters long, try again"})
-                client.send(response_json.encode())
-                print("ack: ", client.recv(4096).decode())
+                await write_packet(writer, response_json)
                 continue
             elif result == 1:
                 response_json = json.dumps({"packet_type": "error", "response": "Invalid word, try again"})
-                client.send(response_json.encode())
-                print("ack: ", client.recv(4096).decode())
+                await write_packet(writer, response_json)
+                continue
+            elif isinstance(result, str): # hard mode
+                response_json = json.dumps({"packet_type": "error", "response": f"{result}, try again"})
+                await write_packet(writer, response_json)
                 continue
 
-            response_json = json.dumps({"packet_type": "wordle_result", "response": result})
-            client.send(response_json.encode())
-            print("ack: ", client.recv(4096).decode())
+            game_over = is_winner(result) or len(wordle.guesses) == guesses_number
+            if not game_over:
+                await save_game(token, wordle) # before the player sees the result, so a resumed game never loses a guess
+            response_json = json.dumps({"packet_type": "wordle_result", "response": wordle.patterns[-1] if pattern_feedback else result,
+                                        "remaining": wordle.remaining_count()})
+            await write_packet(writer, response_json)
+            metrics.observe("packet_seconds", time.perf_counter() - guess_start, packet_type="guess")
 
 
             if is_winner(result):
-                send_gameover(client, token, wordle, win=True)
-                print("ack: ", client.recv(4096).decode())
+                await send_gameover(writer, token, wordle, win=True)
                 break
             elif len(wordle.guesses) == guesses_number:
-                send_gameover(client, token, wordle, win=False)
-                print("ack: ", client.recv(4096).decode())
+                await send_gameover(writer, token, wordle, win=False)
                 break
 
 
 
-def send_gameover(client, token, wordle, win=False):
-    response_json = json.dumps({"packet_type": "game_over",
-                                "game_over_message": "You win!" if win else "You lose!",
-                                "word": wordle.word})
-    client.send(response_json.encode())
-    upload_history({"game_data": {"win": win, "word": wordle.word, "guesses": wordle.guesses}}, token=token)
-
-
-def send_history(client, token):
-    print("Getting stats...")
-    request_json = json.dumps({"packet_type": "get_history", "token": token})
-    history_packet = database_query(request_json)
-    history = json.loads(history_packet)
-    print("Game history:", history)
-    client.send(history_packet.encode())
-def client_thread(client):
+async def send_hint(writer, wordle):
     try:
-        while True:
-            try:
-                choice_json = client.recv(4096).decode()
-                choice = json.loads(choice_json)
-                packet_type = choice["packet_type"]
-                token = choice["token"]
-                if packet_type == "play":
-                    print("playing wordle")
-                    play_wordle(client, token=token)
-                elif packet_type == "history":
-                    send_history(client, token=token)
-                elif packet_type == "clear_history":
-                    print("clearing history")
-                    response = database_query(json.dumps({"packet_type": "clear_history", "token": token}))
-                    client.send(response.encode())
-                elif packet_type == "logout":
-                    print("Player quit")
-                    break
-                elif packet_type == "change_password":
-                    print("changing password")
-                    response = database_query(choice_json)
-                    client.send(response.encode())
-                else:
-                    response_json = json.dumps({"packet_type": "error", "response": "Invalid choice"})
-                    client.send(response_json.encode())
-            except (ConnectionRefusedError, socket.timeout) as e:
-                print("Could not connect:", e)
-                error_json = json.dumps({"packet_type": "error", "response": str(e)})
-                client.send(error_json.encode())
-    except ConnectionResetError as e:
-        print("Connection lost: ", e)
+        solver = await get_solver(wordle.word_length)
+    except (OSError, asyncio.TimeoutError, RuntimeError, ValueError, KeyError) as e:
+        logger.warning("no solver for %d letter words: %r", wordle.word_length, e)
+        solver = None
+    hint, remaining = wordle.hint(solver) if solver is not None else (None, 0)
+    if hint is None:
+        response_json = json.dumps({"packet_type": "error", "response": "No hint available"})
+    else:
+        response_json = json.dumps({"packet_type": "hint", "response": hint, "remaining": remaining})
+    await write_packet(writer, response_json)
+
+
+async def send_gameover(writer, token, wordle, win=False):
+    game_over = {"packet_type": "game_over", "game_over_message": "You win!" if win else "You lose!", "word": wordle.word}
+    if wordle.daily:
+        game_over["daily_rank"] = await add_daily_result(token, wordle, win)
+    await write_packet(writer, json.dumps(game_over))
+    await delete_game(token, wordle)
+    await history_writer.add(token, {"game_data": {"win": win, "word": wordle.word, "guesses": wordle.guesses,
+                                                   "hard_mode": wordle.hard_mode, "remaining": wordle.remaining, "daily": wordle.daily}})
+
+async def add_daily_result(token, wordle, win):
+    """:returns: the player's rank and the number of players of the day so far, None if the result wasn't recorded"""
+    request = {"packet_type": "add_daily_result", "token": token, "date": wordle.daily, "solved": win,
+               "guesses": len(wordle.guesses), "seconds": round(time.time() - wordle.started_at, 3)}
+    try:
+        response = await database_query(request)
+    except (OSError, asyncio.TimeoutError) as e:
+        logger.warning("could not record daily result: %r", e)
+        return None
+    if response["packet_type"] == "error":
+        logger.warning("daily result rejected: %s", response["response"])
+        return None
+    return {"rank": response["rank"], "players": response["players"]}
+
+async def send_leaderboard(writer, token, limit=None):
+    request = {"packet_type": "get_leaderboard", "token": token, "date": today()}
+    if limit is not None:
+        request["limit"] = limit
+    await write_packet(writer, json.dumps(await database_query(request)))
+
+
+async def send_history(writer, token, before=None, limit=None):
+    request = {"packet_type": "get_history", "token": token, "before": before}
+    if limit is not None:
+        request["limit"] = limit
+    await write_packet(writer, json.dumps(await database_query(request)))
+client_packet_types = {"play", "resume", "guess", "hint", "leaderboard", "history", "stats", "clear_history", "logout", "change_password"}
+
+def packet_label(packet_type):
+    """keeps unknown packet types sent by clients from creating a metric each"""
+    return packet_type if packet_type in client_packet_types else "invalid"
+
+async def client_session(reader, writer):
+    while True:
+        try:
+            choice_json = await read_packet(reader)
+            if not choice_json:
+                break # the player closed the connection without logging out
+            choice = json.loads(choice_json)
+            packet_type = choice["packet_type"]
+            token = choice.get("token")
+            metrics.inc("packets_total", packet_type=packet_label(packet_type))
+            logger.debug("packet: %s", packet_type)
+            with nullcontext() if packet_type in ("play", "resume") else metrics.timed("packet_seconds", packet_type=packet_label(packet_type)):
+                await handle_choice(reader, writer, choice, packet_type, token)
+            if packet_type == "logout":
+                break
+        except (ConnectionRefusedError, socket.timeout, asyncio.TimeoutError) as e:
+            logger.warning("backend unavailable: %r", e)
+            error_json = json.dumps({"packet_type": "error", "response": str(e) or "backend timed out"})
+            await write_packet(writer, error_json)
+        except RuntimeError as e: # a backend answered with an error, the player can go on with something else
+            logger.warning("backend error: %r", e)
+            await write_packet(writer, json.dumps({"packet_type": "error", "response": str(e)}))
+
+authenticated_packet_types = {"play", "resume", "leaderboard", "history", "stats", "clear_history", "change_password"}
+logged_out_tokens = {} # token: expires_at, of tokens logged out through this server, until they expire anyway
+logged_out_tokens_pruned_size = 1024
+
+def token_username(token):
+    """:returns: username the token was signed for, None if it is forged, expired or was logged out here,
+    checked with the shared secret alone, the mongo api still checks the session of every request it gets"""
+    claims = tokens.verify(token)
+    if claims is None or token in logged_out_tokens:
+        return None
+    return claims[1]
+
+def forget_token(token):
+    global logged_out_tokens_pruned_size
+    claims = tokens.verify(token)
+    if claims is None:
+        return
+    logged_out_tokens[token] = claims[2]
+    if len(logged_out_tokens) > 2 * logged_out_tokens_pruned_size:
+        now = time.time()
+        for expired in [logged_out for logged_out, expires_at in logged_out_tokens.items() if expires_at < now]:
+            del logged_out_tokens[expired]
+        logged_out_tokens_pruned_size = max(1024, len(logged_out_tokens))
+
+async def handle_choice(reader, writer, choice, packet_type, token):
+    if packet_type in authenticated_packet_types and token_username(token) is None:
+        metrics.inc("rejected_tokens_total", packet_type=packet_type) # never reaches the mongo api
+        await write_packet(writer, json.dumps({"packet_type": "error", "response": "invalid or expired token, log in again"}))
+        return
+    if packet_type in ("history", "stats", "clear_history", "logout"):
+        await history_writer.wait_for(token) # the player's last game may still be queued
+    if packet_type == "play":
+        await play_wordle(reader, writer, token=token, hard_mode=bool(choice.get("hard_mode")), daily=bool(choice.get("daily")),
+                          word_length=choice.get("word_length", 5), guesses_number=choice.get("guesses_number", 6),
+                          pattern_feedback=choice.get("feedback") == "pattern")
+    elif packet_type == "resume":
+        await resume_wordle(reader, writer, token=token, pattern_feedback=choice.get("feedback") == "pattern")
+    elif packet_type == "leaderboard":
+        await send_leaderboard(writer, token=token, limit=choice.get("limit"))
+    elif packet_type == "history":
+        await send_history(writer, token=token, before=choice.get("before"), limit=choice.get("limit"))
+    elif packet_type == "stats":
+        response = await database_query({"packet_type": "get_stats", "token": token})
+        await write_packet(writer, json.dumps(response))
+    elif packet_type == "clear_history":
+        response = await database_query({"packet_type": "clear_history", "token": token})
+        await write_packet(writer, json.dumps(response))
+    elif packet_type == "logout":
+        logger.debug("player quit")
+        if token_username(token) is not None:
+            forget_token(token)
+            await database_query({"packet_type": "logout", "token": token})
+    elif packet_type == "change_password":
+        response = await auth_query(choice)
+        await write_packet(writer, json.dumps(response))
+    else:
+        response_json = json.dumps({"packet_type": "error", "response": "Invalid choice"})
+        await write_packet(writer, response_json)
+
+async def login(reader, writer):
+    """forwards the login/register packet to the mongo api, :returns: True if the player is now logged in"""
+    request_json = await read_packet(reader)
+    if not request_json:
+        return False
+    request = json.loads(request_json)
+    peer = writer.get_extra_info("peername")
+    forwarded_for = request.pop("forwarded_for", None)
+    request["client_address"] = peer[0] if peer else None # the mongo api rate limits logins per player address, it only sees ours
+    if trust_forwarded_for and forwarded_for:
+        request["client_address"] = forwarded_for
+    with metrics.timed("packet_seconds", packet_type="login"):
+        try:
+            response = await auth_query(request)
+        except (ConnectionError, OSError, asyncio.TimeoutError) as e: # the player gets an answer before the connection closes
+            logger.warning("backend unavailable: %r", e)
+            response = {"packet_type": "error", "response": str(e) or "backend timed out"}
+        await write_packet(writer, json.dumps(response))
+    logger.debug("login response: %s", response)
+    return response["response"] == "success"
+
+async def handle_player(reader, writer):
+    """runs one player's connection, from login to logout, as a task on the event loop"""
+    global active_players
+    logger.debug("player connected from %s", writer.get_extra_info("peername"))
+    active_players += 1
+    try:
+        if await login(reader, writer):
+            await client_session(reader, writer)
+    except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+        logger.info("connection lost: %r", e)
     except json.decoder.JSONDecodeError as e:
-        print("Invalid json: ", e, "closing connection")
+        logger.warning("invalid json, closing connection: %s", e)
+    except Exception as e:
+        logger.exception("player session failed: %r", e)
     finally:
-        client.close()
-
-def main():
-    print("Starting wordle server... ", time.time())
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind(("0.0.0.0", wordle_port))
-    server.listen()
-
-    client_threads = []
-    while True:
+        active_players -= 1
+        writer.close()
+
+async def drain(timeout):
+    """waits until every connected player left, or timeout seconds"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while active_players and loop.time() < deadline:
+        await asyncio.sleep(0.5)
+
+async def serve():
+    global mongo_api_pool, mongo_auth_pool, dictionary_pool, history_writer
+    mongo_api_pool = ConnectionPool(mongo_api_ip, mongo_api_port)
+    mongo_auth_pool = ConnectionPool(mongo_api_ip, mongo_api_port, max_size=auth_pool_size, shared_size=1)
+    dictionary_pool = ConnectionPool(dictionary_server_ip, dictionary_server_port)
+    history_writer = HistoryWriter()
+    history_writer.start()
+    solver_preload = asyncio.ensure_future(preload_solvers()) # noqa: F841, kept referenced while serving
+    metrics.gauge("active_players", lambda: active_players)
+
+    stop = asyncio.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
         try:
-            print("wordle waiting for connections...")
-            client, addr = server.accept()
-            print("player connected from: ", addr)
-
-            request_json = client.recv(4096).decode()
-
-            response_json = database_query(request_json)
-            client.send(response_json.encode())
-            print("sending response: ", response_json)
-            if json.loads(response_json)["response"] == "success":
-                wordle_thread = threading.Thread(target=client_thread, args=(client,))
-                client_threads.append(wordle_thread)
-                wordle_thread.start()
+            asyncio.get_running_loop().add_signal_handler(signal_number, stop.set)
+        except (NotImplementedError, RuntimeError): # windows, or not the main thread
+            pass
+
+    server = await asyncio.start_server(handle_player, "0.0.0.0", wordle_port)
+    logger.info("waiting for connections on port %d", wordle_port)
+    async with server:
+        await stop.wait()
+        server.close() # the router's health check now fails, so new players go to the other servers
+        logger.info("draining %d players", active_players)
+        await drain(drain_timeout)
+    logger.info("shutting down, flushing %d queued games", history_writer.queue.qsize())
+    await history_writer.close()
 
-        except Exception as e:
-            print("Connection lost: ", e)
-            continue
+def main():
+    logger.info("starting wordle server")
+    if tokens.is_default_secret():
+        logger.warning("TOKEN_SECRET is not set, tokens are checked with an insecure default")
+    metrics.serve(metrics_port)
+    asyncio.run(serve())
 
 if __name__ == '__main__':
     main()
-